@@ -1,38 +1,343 @@
 
 
-from pypixxlib import _libdpx as dp
 import pandas as pd
+import numpy as np
 
+# The device backend.  Without pypixxlib, only the simulated tracker can
+# be used (see use_simulated_tracker).
+try:
+  from pypixxlib import _libdpx as dp
+except ImportError:
+  dp = None
+
+# Stores the gaze data of a session in one append-only binary file:
+# little-endian float64, one row per sample, columns as in gaze_columns
+# (see logformat.py).  The samples of a trial form a contiguous block of
+# rows which may be appended in several chunks.  The trial refers to its block in
+# metadata2 as "filename:first row:number of rows" (see ref).  Writing
+# is done by a background worker.
+class GazeStore:
+  def __init__(self, filename):
+    self.filename = filename
+    self.rowsize  = 8 * len(gaze_columns)
+    self.file     = open(filename, "ab")
+    # A resumed session may have left an incomplete row at the end:
+    self.nrows    = os.path.getsize(filename) // self.rowsize
+    self.file.truncate(self.nrows * self.rowsize)
+    self.worker   = BackgroundWorker("gaze store", 64)
+    cleanup_handlers.append(self.close)
+  def append(self, data):
+    data = np.asarray(data, dtype='<f8').reshape(-1, len(gaze_columns))
+    self.nrows += len(data)
+    self.worker.submit(self.write, data)
+  # Reference to the block from row start to the current end:
+  def ref(self, start):
+    return f"{os.path.basename(self.filename)}:{start}:{self.nrows - start}"
+  def write(self, data):
+    self.file.write(data)
+    self.file.flush()
+  def close(self):
+    self.worker.drain()
+    self.file.close()
+
+# Loads the gaze data of one trial as a data frame without reading the
+# rest of the file.  ref is the content of metadata2 of the trial (see
+# read_gaze in logformat.py).
+def load_gaze(ref, data_dir="data"):
+  return pd.DataFrame(read_gaze(ref, data_dir), columns=gaze_columns)
+
+# Synchronization of the host clock (session_time) with the clock of the
+# tracker (DPxGetTime, which also provides the TimeTag of the gaze
+# samples).  sample pairs a host timestamp with a reading of the device
+# clock.  The host time is the midpoint of the register update that
+# fetched the device time; of several readings, the one with the
+# shortest round trip is used and half of its round trip is recorded as
+# the uncertainty.  The pairs are appended to
+# data/<session ID>_clocksync.tsv.  A linear model (offset and drift)
+# is fitted to the pairs of each run of the session (a resumed session
+# starts a new run since the host clock may have been restarted) and
+# stored in data/<session ID>_clocksync.json when the experiment ends.
+# See tracker_time for converting times of the session log.
+class ClockSync:
+  def __init__(self, filename):
+    self.filename = filename
+    self.pairs    = []
+    self.run      = 0
+    # A session that crashed early may have left an empty or header-only
+    # file, which counts as no runs.
+    new = not os.path.exists(filename) or os.path.getsize(filename) == 0
+    if not new:
+      runs = pd.read_csv(filename, sep="\t")["run"].dropna()
+      if len(runs) > 0:
+        self.run = int(runs.max()) + 1
+    self.file = open(filename, "a")
+    if new:
+      self.file.write("run\thost\tdevice\tuncertainty\n")
+    cleanup_handlers.append(self.close)
+  def sample(self, readings=5):
+    best = None
+    for _ in range(readings):
+      t0 = time.perf_counter()
+      dp.DPxUpdateRegCache()
+      t1 = time.perf_counter()
+      if best is None or t1 - t0 < best[1] - best[0]:
+        best = (t0, t1, dp.DPxGetTime())
+    t0, t1, device = best
+    pair = ((t0 + t1)/2 - exp_starttime, device, (t1 - t0)/2)
+    self.pairs.append(pair)
+    self.file.write("%d\t%.7f\t%.7f\t%.7f\n" % (self.run, *pair))
+    return pair
+  # Called at the end of each trial, so that the pairs of a crashed
+  # session are still available.
+  def flush(self):
+    self.file.flush()
+  # Runs with fewer than two pairs (a session that crashed right after
+  # the recording started) can't be fitted and are left out.
+  def close(self):
+    self.file.close()
+    data = pd.read_csv(self.filename, sep="\t")
+    models = [fit_clock_model(d) | {"run": int(run)}
+              for run, d in data.groupby("run") if len(d) >= 2]
+    with open(re.sub(r'\.tsv$', '', self.filename) + ".json", "w") as f:
+      json.dump(models, f, indent=1)
+
+# Least-squares fit of device = offset + slope * host to the pairs of one
+# run.  Returns the model with the host time range it covers and the
+# largest residual (seconds).
+def fit_clock_model(pairs):
+  host, device = pairs["host"].to_numpy(), pairs["device"].to_numpy()
+  if len(host) < 2:
+    raise ValueError(f"At least two clock pairs are needed for a clock model, got {len(host)}")
+  if np.ptp(host) > 0:
+    slope, offset = np.polyfit(host, device, 1)
+  else:
+    slope, offset = 1.0, float(np.mean(device - host))
+  residuals = device - (offset + slope*host)
+  return {"offset": float(offset), "slope": float(slope),
+          "drift_ppm": float(1e6*(slope - 1)),
+          "residual_max": float(np.max(np.abs(residuals))),
+          "start": float(host.min()), "end": float(host.max()),
+          "n": len(host)}
+
+# Converts session times (e.g. starttime and endtime in the session log)
+# to the device clock, i.e. to the TimeTag of the gaze samples.  Uses the
+# model of the run whose time range is closest to each time.
+def tracker_time(t, session, data_dir="data"):
+  with open(os.path.join(data_dir, f"{session}_clocksync.json")) as f:
+    models = json.load(f)
+  if not models:
+    raise ValueError(f"No clock model for session {session}: fewer than two clock pairs were recorded")
+  t = np.asarray(t, dtype=float)
+  distance = np.array([np.maximum(np.maximum(m["start"] - t, t - m["end"]), 0) for m in models])
+  best = np.argmin(distance, axis=0)
+  offset = np.array([m["offset"] for m in models])[best]
+  slope  = np.array([m["slope"] for m in models])[best]
+  return offset + slope*t
+
+# Polls the eye position at a fixed rate in a separate thread and stores
+# it in a preallocated ring buffer, so that sampling doesn't depend on
+# how busy the GUI is.  Columns: host time (time.perf_counter), left x,
+# left y, right x, right y.  The sampling thread is the only writer and
+# increments the count only after a sample was written, so readers
+# don't need a lock.  Triggers are functions of a sample (lx, ly, rx,
+# ry).  When a trigger returns true, the sampling thread sends an event
+# with the trigger's key to the window.  The value of the event is the
+# run_id, so that events from earlier trials can be ignored.  If a
+# drain function is given, the sampling thread also calls it every
+# drain_interval seconds.
+class GazeSampler:
+  def __init__(self, rate=1000, capacity=8192, drain_interval=0.1):
+    self.period   = 1/rate
+    self.drain_interval = drain_interval
+    self.buffer   = np.zeros((capacity, 5))
+    self.count    = 0
+    self.run_id   = 0
+    self.thread   = None
+    self.running  = False
+    self.triggers = {}
+    self.trigger_times = {}
+    # Drift correction in tracker coordinates, subtracted from every
+    # sample (see TPxDriftCheck):
+    self.offset   = (0, 0)
+  def start(self, window, triggers={}, drain=None):
+    self.window   = window
+    self.triggers = dict(triggers)
+    self.drain    = drain
+    self.trigger_times = {}
+    self.count    = 0
+    self.run_id  += 1
+    self.starttime = time.perf_counter()
+    self.running  = True
+    self.thread   = threading.Thread(target=self.run, name="gaze sampler", daemon=True)
+    self.thread.start()
+  def stop(self):
+    self.running = False
+    if self.thread:
+      # The sampling thread may be waiting for the GUI thread (see
+      # GUICall), so Tk events are processed until it has ended:
+      self.thread.join(0.01)
+      while self.thread.is_alive():
+        self.window.TKroot.update()
+        self.thread.join(0.001)
+      self.thread = None
+    self.stoptime = time.perf_counter()
+  # Samples per second in the last run:
+  def achieved_rate(self):
+    return self.count / (self.stoptime - self.starttime)
+  def run(self):
+    capacity = len(self.buffer)
+    dx, dy = self.offset
+    next_time = next_drain = time.perf_counter()
+    while self.running:
+      dp.DPxUpdateRegCache()
+      t = time.perf_counter()
+      lx, ly, rx, ry = dp.TPxGetEyePosition()[0:4]
+      sample = (lx-dx, ly-dy, rx-dx, ry-dy)
+      self.buffer[self.count % capacity] = (t, *sample)
+      self.count += 1
+      for key, trigger in list(self.triggers.items()):
+        if trigger(*sample):
+          self.trigger_times[key] = t
+          del self.triggers[key]
+          self.window.write_event_value(key, self.run_id)
+      if self.drain and t >= next_drain:
+        self.drain()
+        next_drain = t + self.drain_interval
+      # Sleep until the next sample is due.  If we fell behind, we don't
+      # try to catch up:
+      next_time += self.period
+      delay = next_time - time.perf_counter()
+      if delay > 0:
+        time.sleep(delay)
+      else:
+        next_time = time.perf_counter()
+  def latest(self):
+    count = self.count
+    if count == 0:
+      return None
+    return self.buffer[(count-1) % len(self.buffer)].copy()
+  # Returns (a copy of) the last n samples, oldest first.  n should be
+  # well below the capacity since the oldest samples are overwritten
+  # while the sampling thread is running.
+  def recent(self, n):
+    count = self.count
+    n = min(n, count, len(self.buffer))
+    return self.buffer[np.arange(count-n, count) % len(self.buffer)]
+
+# Calls a function in the GUI thread on behalf of another thread (e.g.
+# the sampling thread) with as little delay as possible.  Tk widgets
+# may only be changed in the GUI thread.  When a Tcl variable is set
+# from another thread, tkinter passes this on to the GUI thread where
+# the variable's trace is executed right away, without the round trip
+# through window.read.  The calling thread waits until the function
+# has returned.  close removes the trace (and its Tcl command) when the
+# call isn't needed anymore.
+class GUICall:
+  def __init__(self, window, function):
+    self.root  = window.TKroot
+    self.var   = tkinter.StringVar(self.root)
+    self.trace = self.var.trace_add("write", lambda *_: function())
+  def __call__(self):
+    self.root.tk.willdispatch()
+    self.var.set("")
+  def close(self):
+    self.var.trace_remove("write", self.trace)
+
+# With persistent=True, the device is opened and the tracker woken up
+# only once instead of for every trial.  Per trial, only the recording
+# schedule is started and stopped.  The device is closed when the
+# experiment ends, also when it is aborted.
 class TPx:
+  def __init__(self, persistent=True, sampling_rate=1000):
+    self.persistent = persistent
+    self.is_open    = False
+    self.sampler    = GazeSampler(sampling_rate)
+    self.store      = None
+    self.clock      = None
+  def open(self):
+    if self.is_open:
+      return
+    with trace("tpx_open"):
+      dp.DPxOpen()
+      dp.DPxSetTPxAwake()
+      dp.DPxUpdateRegCache()
+    self.is_open = True
+    if self.close not in cleanup_handlers:
+      cleanup_handlers.append(self.close)
+  def close(self):
+    if not self.is_open:
+      return
+    with trace("tpx_close"):
+      dp.DPxSetTPxSleep()
+      dp.DPxUpdateRegCache()
+      dp.DPxClose()
+    self.is_open = False
   def calibrate(self, skipCameraSetup=False):
+    # A new calibration makes the drift correction obsolete:
+    self.sampler.offset = (0, 0)
+    # The simulated tracker needs no calibration:
+    if getattr(dp, "simulated", False):
+      return
+    # The calibration opens and closes the device itself:
+    self.close()
     while not TPxSimpleCalibration(skipCameraSetup):
       continue
   def start_recording(self):
-    dp.DPxOpen()
-    dp.DPxSetTPxAwake()
-    self.TPxSetupSchedule = dp.TPxSetupSchedule()
-    dp.TPxStartSchedule()
-    dp.DPxUpdateRegCache()
+    self.open()
+    if not self.store:
+      self.store = GazeStore(f"data/{session_id}_gaze.bin")
+      self.clock = ClockSync(f"data/{session_id}_clocksync.tsv")
+    self.block_start = self.store.nrows
+    with trace("tpx_start_recording"):
+      self.TPxSetupSchedule = dp.TPxSetupSchedule()
+      dp.TPxStartSchedule()
+      dp.DPxUpdateRegCache()
+      self.clock.sample()
+    self.recording_starttime = time.perf_counter()
+  # Waits until the first sample is in the buffer and returns the time
+  # in seconds since the recording was started (None after timeout).
+  def wait_for_first_sample(self, timeout=1):
+    while time.perf_counter() - self.recording_starttime < timeout:
+      dp.DPxUpdateRegCache()
+      dp.TPxGetStatus(self.TPxSetupSchedule)
+      if self.TPxSetupSchedule['newBufferFrames'] > 0:
+        return time.perf_counter() - self.recording_starttime
+    return None
   def stop_recording(self):
-    dp.TPxStopSchedule()
-    dp.DPxUpdateRegCache()
-    dp.TPxGetStatus(self.TPxSetupSchedule)
+    with trace("tpx_stop_recording"):
+      dp.TPxStopSchedule()
+      dp.DPxUpdateRegCache()
+      dp.TPxGetStatus(self.TPxSetupSchedule)
+      self.clock.sample()
+      self.clock.flush()
+  # Moves the samples that are currently in the device buffer to the gaze
+  # store.  During a trial, this is done in chunks by the sampling
+  # thread, so that the device buffer can't overflow during long trials
+  # and the transfer at the end of the trial is small.  Also pairs the
+  # host clock with the device clock (one reading, so that the sampling
+  # thread isn't delayed).  Returns the number of samples.
+  def drain_buffer(self):
+    with trace("tpx_drain"):
+      self.clock.sample(1)
+      dp.TPxGetStatus(self.TPxSetupSchedule)
+      n = self.TPxSetupSchedule['newBufferFrames']
+      if n > 0:
+        self.store.append(dp.TPxReadData(self.TPxSetupSchedule, n))
+    return n
+  # Stores the rest of the samples and returns the reference to the
+  # trial's block in the gaze store:
   def retrieve_data(self):
-    data = dp.TPxReadData(self.TPxSetupSchedule, self.TPxSetupSchedule['newBufferFrames'])
-    columns = ['TimeTag', 'LeftEyeX', 'LeftEyeY',
-               'LeftPupilDiameter', 'RightEyeX', 'RightEyeY',
-               'RightPupilDiameter', 'DigitalIn', 'LeftBlink', 'RightBlink',
-               'DigitalOut', 'LeftEyeFixationFlag', 'RightEyeFixationFlag',
-               'LeftEyeSaccadeFlag', 'RightEyeSaccadeFlag', 'MessageCode',
-               'LeftEyeRawX', 'LeftEyeRawY', 'RightEyeRawX', 'RightEyeRawY']
-    dp.DPxSetTPxSleep()
-    dp.DPxUpdateRegCache()
-    dp.DPxClose()
-    return pd.DataFrame(data, columns=columns)
+    self.final_transfer = self.drain_buffer()
+    if not self.persistent:
+      self.close()
+    return self.store.ref(self.block_start)
 
 # Chamois ReadingTrial but with TRACKPixx3 recording:
 
 class TPxReadingTrial(ReadingTrial):
+  # Simulated participants leave the end of the trial to the
+  # (simulated) eye-tracker:
+  ends_by_gaze = True
   def __init__(self, item, condition, s, tpx, trigger_radius=200):
     super().__init__(item, condition, s)
     self.tpx = tpx
@@ -43,44 +348,202 @@ class TPxReadingTrial(ReadingTrial):
   def deactivate(self):
     self.tpx.stop_recording()
     super().deactivate()
-    data_frame = self.tpx.retrieve_data()
-    filename = "data/%s_%03d_%s_%03d_%s.csv" % (session_id, self.pno, self.type, self.item, self.condition)
-    data_frame.to_csv(filename, index=False)
-    self.metadata2 = filename
+    with trace("tpx_retrieve", self):
+      self.metadata2 = self.tpx.retrieve_data()
+    self.metrics["final_transfer"] = self.tpx.final_transfer
+  # Gaze triggers that are checked by the sampling thread for every
+  # sample (see GazeSampler):
+  def triggers(self, window):
+    # Checking if participant is looking at corner of screen:
+    w, h = window.size
+    def in_corner(lx, ly, rx, ry):
+      # TP3 uses center as origin:
+      x = (lx+rx)/2 + w/2
+      y = (ly+ry)/2 + h/2
+      return math.sqrt((x-w)**2 + y**2) < self.trigger_radius
+    return {"-CORNER-": in_corner}
   def handle_event(self, window):
     # If we start sampling gaze too early there's no data yet:
-    time.sleep(0.05)
-    w, h = window.size
+    with trace("tpx_first_sample", self):
+      latency = self.tpx.wait_for_first_sample()
+    self.metrics["first_sample_latency"] = f"{1000*latency:.1f}" if latency is not None else "NA"
+    sampler = self.tpx.sampler
+    sampler.start(window, self.triggers(window), self.tpx.drain_buffer)
     while True:
       # Checking keyboard events:
-      self.event, self.values = window.read(timeout=1)
-      if self.event=="__TIMEOUT__":
-        pass
+      self.event, self.values = window.read()
       # Weird but sometimes event is None when the window is closed.
       # Even with the None check in pace we sometimes get a messy
       # abort and stack trace.
-      elif not self.event or self.event == WIN_CLOSED:
+      if not self.event or self.event == WIN_CLOSED:
+        sampler.stop()
         dp.DPxUpdateRegCache()
         self.tpx.stop_recording()
         raise ExperimentAbortException()
+      elif self.event == "-CORNER-":
+        if self.values[self.event] == sampler.run_id:
+          break
       elif self.event.startswith('space:'):
         break
       elif self.event.startswith('Escape:'):
         self.response = "ABORTED"
         print("  Page aborted.")
         break
-      # Checking if participant is looking at corner of screen:
-      dp.DPxUpdateRegCache()
-      eyeData = dp.TPxGetEyePosition()
-      lx, ly, rx, ry = eyeData[0:4]
-      # TP3 uses center as origin:
-      x = (lx+rx)/2 + w/2
-      y = (ly+ry)/2 + h/2
-      if math.sqrt((x-w)**2 + y**2) < self.trigger_radius:
-        break
+    sampler.stop()
+    self.metrics["sampling_rate"] = f"{sampler.achieved_rate():.0f}"
+    # Drift correction that was applied to the live gaze (the recorded
+    # data is uncorrected):
+    if sampler.offset != (0, 0):
+      self.metrics["offset_x"], self.metrics["offset_y"] = (f"{v:.1f}" for v in sampler.offset)
+    # Time from the gaze sample in the corner to the end of the trial:
+    if "-CORNER-" in sampler.trigger_times:
+      self.metrics["trigger_latency"] = f"{1000*(time.perf_counter() - sampler.trigger_times['-CORNER-']):.1f}"
     dp.DPxUpdateRegCache()
     self.deactivate()
 
+# Boundary paradigm: the word at index target (counting from 0) is
+# first displayed as preview.  As soon as the gaze crosses an invisible
+# boundary at the left edge of that word, the preview is replaced by
+# the target word, ideally during the saccade.  The boundary is checked
+# by the sampling thread for every gaze sample, and the swap is done
+# directly on the Tk label of the word (see GUICall), which is resolved
+# before the trial starts.  Preview and target must have the same
+# width, so that the swap doesn't move the following words.  The time
+# from the gaze sample beyond the boundary to the end of the swap
+# (redrawn label sent to the display server) is logged as
+# boundary_latency, the time of that sample as boundary_time.
+class TPxBoundaryTrial(TPxReadingTrial):
+  def __init__(self, item, condition, s, tpx, target, preview, trigger_radius=200):
+    words = s.split()
+    self.target      = target
+    self.target_word = words[target]
+    self.preview     = preview
+    if text_width(preview) != text_width(self.target_word):
+      raise RuntimeError(f"Preview “{preview}” and target “{self.target_word}” differ in width (item {item}, condition {condition}).")
+    words[target] = preview
+    super().__init__(item, condition, " ".join(words), tpx, trigger_radius)
+    # AOIs and the log refer to the sentence with the target word:
+    self.stimulus  = s
+    self.swap_time = None
+  def prelude(self, window):
+    # The label displays the value of a Tcl variable:
+    self.label    = self.words[self.target].widget
+    self.text_var = text_variable(self.words[self.target])
+    self.swap     = GUICall(window, self.show_target)
+    super().prelude(window)
+  # Runs in the GUI thread:
+  def show_target(self):
+    self.label.setvar(self.text_var, self.target_word)
+    self.label.update_idletasks()
+    self.swap_time = time.perf_counter()
+  def triggers(self, window):
+    w, h = window.size
+    boundary = self.boxes[self.target][0] - w/2
+    # Only a crossing from the left counts, not a gaze that is still
+    # beyond the boundary when the trial starts:
+    armed = False
+    def crossed(lx, ly, rx, ry):
+      nonlocal armed
+      x = (lx+rx)/2
+      if x < boundary:
+        armed = True
+      elif armed and x > boundary:
+        self.swap()
+        return True
+      return False
+    return {**super().triggers(window), "-BOUNDARY-": crossed}
+  def measure_aois(self):
+    self.boxes = super().measure_aois()
+    return self.boxes
+  def deactivate(self):
+    t = self.tpx.sampler.trigger_times.get("-BOUNDARY-")
+    if t is not None and self.swap_time is not None:
+      self.metrics["boundary_time"] = f"{t - exp_starttime:.6f}"
+      self.metrics["boundary_latency"] = f"{1000*(self.swap_time - t):.2f}"
+    else:
+      self.metrics["boundary_time"] = self.metrics["boundary_latency"] = "NA"
+    # The sampling thread has stopped, so the swap can't be called anymore:
+    self.swap.close()
+    super().deactivate()
+
+# Single-point drift check: shows the fixation cross at the position
+# where it appears in ReadingTrials and measures for duration seconds
+# (after settle seconds for the saccade to the cross) where the live
+# gaze is relative to the cross.  If the error is at most tolerance
+# pixels, the calibration is accepted as it is.  Up to threshold pixels,
+# the error is added to the drift correction that the sampling thread
+# subtracts from the gaze (used by triggers during the following
+# trials).  Beyond threshold, or without valid samples, the tracker is
+# recalibrated (which resets the drift correction).  The outcome
+# ("accepted", "corrected", "recalibrated") is stored in the response
+# column, the error in the Metrics row (drift_x, drift_y, drift_error
+# in pixels, and the drift correction in effect afterwards as offset_x,
+# offset_y).
+class TPxDriftCheck(Page):
+  def __init__(self, tpx, tolerance=30, threshold=100, settle=0.2, duration=0.5):
+    super().__init__(None)
+    self.tpx       = tpx
+    self.tolerance = tolerance
+    self.threshold = threshold
+    self.settle    = settle
+    self.duration  = duration
+  # Uses the widgets of ReadingTrials, so that the cross is at the same
+  # position:
+  def attach(self, window):
+    self.recycled = recycle_widgets
+    if self.recycled:
+      self.template = borrow_template(window, "ReadingTrial", lambda: ReadingTemplate(word_slots))
+    else:
+      self.template = ReadingTemplate(0)
+      self.template.attach(window)
+    self.column = self.template.column
+    self.fixation_cross = self.template.fixation_cross
+  def detach(self, window):
+    self.fixation_cross.hide()
+    if not self.recycled:
+      self.template.detach(window)
+  def handle_event(self, window):
+    self.fixation_cross.show()
+    window.refresh()
+    self.tpx.open()
+    sampler = self.tpx.sampler
+    start = time.perf_counter()
+    sampler.start(window)
+    wait_until(window, start + self.settle + self.duration)
+    sampler.stop()
+    dp.DPxUpdateRegCache()
+    samples = sampler.recent(sampler.count)
+    samples = samples[samples[:,0] >= start + self.settle]
+    x = (samples[:,1] + samples[:,3])/2
+    y = (samples[:,2] + samples[:,4])/2
+    valid = np.isfinite(x) & np.isfinite(y)
+    # Center of the cross in tracker coordinates (origin in the center,
+    # y pointing up):
+    w, h = window.size
+    canvas = self.fixation_cross.widget
+    cx = canvas.winfo_rootx() + canvas.winfo_width()/2 - w/2
+    cy = h/2 - (canvas.winfo_rooty() + canvas.winfo_height()/2)
+    if valid.any():
+      dx = np.median(x[valid]) - cx
+      dy = np.median(y[valid]) - cy
+      error = math.hypot(dx, dy)
+    else:
+      dx = dy = error = math.nan
+    for name, v in (("drift_x", dx), ("drift_y", dy), ("drift_error", error)):
+      self.metrics[name] = f"{v:.1f}" if valid.any() else "NA"
+    self.metrics["valid_samples"] = f"{valid.sum()}"
+    self.deactivate()
+    if error <= self.tolerance:
+      self.response = "accepted"
+    elif error <= self.threshold:
+      ox, oy = sampler.offset
+      sampler.offset = (ox + dx, oy + dy)
+      self.response = "corrected"
+    else:
+      self.tpx.calibrate(True)
+      self.response = "recalibrated"
+    self.metrics["offset_x"], self.metrics["offset_y"] = (f"{v:.1f}" for v in sampler.offset)
+
 # Shares an interface with Page but is not itself a page since
 # it is not itself part of the GUI.
 class TPxCalibration():
@@ -92,16 +555,17 @@ class TPxCalibration():
     self.completed = None
   def activate(self, _, pno):
     self.pno = pno
-    self.starttime = round(time.time() - exp_starttime, 3)
-    self.tpx.calibrate()
+    self.starttime = session_time()
+    with trace("calibrate", self):
+      self.tpx.calibrate()
     self.completed = True
   def get_data(self):
-    return (self.pno, self.type, self.starttime, None, None, None, None, None, None, None, None)
+    return (self.pno, self.type, f"{self.starttime:.6f}", None, None, None, None, None, None, None, None)
 
 class TPxQuickCalibration(TPxCalibration):
   def activate(self, _, pno):
     self.pno = pno
-    self.starttime = round(time.time() - exp_starttime, 3)
+    self.starttime = session_time()
     self.tpx.calibrate(True)
     self.completed = True
 
@@ -124,14 +588,193 @@ class TPxNext(Instructions):
         self.tpx.calibrate(True)
     self.deactivate()
 
+#
+# Simulated TRACKPixx3
+#
+
+# Software stand-in for pypixxlib's _libdpx for development machines and
+# benchmarks.  Implements the functions used by TPx with the same
+# semantics: samples are recorded into a device buffer of limited size
+# while the schedule is running, TPxGetStatus reports the number of new
+# frames, TPxReadData returns them (same 20 columns, TimeTag in seconds
+# on the device clock), and DPxGetTime and TPxGetEyePosition refer to
+# the time of the last DPxUpdateRegCache.  Coordinates are in pixels
+# with the origin in the center of the screen (y pointing up).
+#
+# The gaze follows a simple reading model: fixations (gamma-distributed
+# durations) along a line of text at y=0, forward saccades with
+# occasional regressions, blinks, and Gaussian noise.  At the end of
+# the line, the eyes move to the lower right corner (ending the trial)
+# and then back to the start of the line.  speed > 1 makes the device
+# clock run faster than real time.
+class SimulatedTRACKPixx:
+  simulated = True
+  FIXATION, SACCADE, BLINK = 0, 1, 2
+  def __init__(self, rate=2000, screen=(1920, 1080), buffer_frames=2**20,
+               fixation_duration=(0.22, 0.08), saccade_amplitude=(120, 40),
+               regression_probability=0.12, blink_probability=0.03,
+               blink_duration=0.12, noise=3, speed=1, seed=None):
+    self.rate          = rate
+    self.screen        = screen
+    self.buffer_frames = buffer_frames
+    self.fixation_duration = fixation_duration
+    self.saccade_amplitude = saccade_amplitude
+    self.regression_probability = regression_probability
+    self.blink_probability = blink_probability
+    self.blink_duration = blink_duration
+    self.noise         = noise
+    self.speed         = speed
+    self.rng           = np.random.default_rng(seed)
+    self.is_open       = False
+    self.recording     = False
+    self.overflows     = 0
+    self.powerontime   = time.perf_counter()
+  # Device clock in seconds since the device was "switched on":
+  def now(self):
+    return (time.perf_counter() - self.powerontime) * self.speed
+  def DPxOpen(self):
+    self.cache_time  = self.now()
+    self.next_sample = int(self.cache_time*self.rate) + 1
+    self.latest      = np.zeros(len(gaze_columns))
+    self.buffer      = []
+    self.unread      = 0
+    # Planned eye movements: start, end, kind, from x, from y, to x, to y
+    self.segments    = []
+    self.plan_time   = self.cache_time
+    self.plan_pos    = self.line_start()
+    self.is_open     = True
+  def DPxClose(self):
+    self.is_open = False
+  def DPxSetTPxAwake(self):
+    pass
+  def DPxSetTPxSleep(self):
+    pass
+  def DPxWriteRegCache(self):
+    pass
+  def DPxUpdateRegCache(self):
+    self.cache_time = self.now()
+    self.generate(self.cache_time)
+  def DPxGetTime(self):
+    return self.cache_time
+  def TPxSetupSchedule(self):
+    self.buffer = []
+    self.unread = 0
+    return {'bufferBaseAddress': 0, 'numBufferFrames': self.buffer_frames,
+            'newBufferFrames': 0, 'currentReadAddr': 0}
+  def TPxStartSchedule(self):
+    self.recording = True
+  def TPxStopSchedule(self):
+    self.generate(self.now())
+    self.recording = False
+  def TPxGetStatus(self, schedule):
+    schedule['newBufferFrames'] = self.unread
+  def TPxReadData(self, schedule, n):
+    data = self.take(n)
+    schedule['newBufferFrames'] = self.unread
+    schedule['currentReadAddr'] += len(data)
+    return data
+  # Removes the n oldest frames from the buffer and returns them:
+  def take(self, n):
+    data = np.concatenate(self.buffer) if self.buffer else np.zeros((0, len(gaze_columns)))
+    n = min(n, len(data))
+    self.buffer = [data[n:]]
+    self.unread = len(data) - n
+    return data[:n]
+  def TPxGetEyePosition(self):
+    s = self.latest
+    return [s[1], s[2], s[4], s[5], s[0]]
+  def line_start(self):
+    return (-self.screen[0]/2 + 100, 0)
+  # Plans the next fixation and the saccade that follows it:
+  def plan(self):
+    t = self.plan_time
+    x, y = self.plan_pos
+    w, h = self.screen
+    mean, sd = self.fixation_duration
+    d = self.rng.gamma((mean/sd)**2, sd**2/mean)
+    if self.rng.random() < self.blink_probability:
+      self.segments.append((t, t+d/2, self.FIXATION, x, y, x, y))
+      self.segments.append((t+d/2, t+d/2+self.blink_duration, self.BLINK, x, y, x, y))
+      t += self.blink_duration
+      self.segments.append((t+d/2, t+d, self.FIXATION, x, y, x, y))
+    else:
+      self.segments.append((t, t+d, self.FIXATION, x, y, x, y))
+    t += d
+    corner = (w/2 - 40, -h/2 + 40)
+    if (x, y) == corner:
+      tx, ty = self.line_start()
+    elif x > w/2 - 300:
+      tx, ty = corner
+    else:
+      mean, sd = self.saccade_amplitude
+      amplitude = max(10, self.rng.normal(mean, sd))
+      if self.rng.random() < self.regression_probability and x > self.line_start()[0] + amplitude:
+        amplitude = -amplitude/2
+      tx, ty = x + amplitude, y
+    # Saccade duration from the main sequence (about 2 ms per degree):
+    duration = 0.02 + math.hypot(tx-x, ty-y) / 15000
+    self.segments.append((t, t+duration, self.SACCADE, x, y, tx, ty))
+    self.plan_time = t + duration
+    self.plan_pos = (tx, ty)
+  # Generates all samples up to the given time:
+  def generate(self, until):
+    k = np.arange(self.next_sample, int(until*self.rate) + 1)
+    if len(k) == 0:
+      return
+    self.next_sample = k[-1] + 1
+    t = k / self.rate
+    while self.plan_time <= t[-1]:
+      self.plan()
+    # Forget segments that are over:
+    while self.segments[0][1] < t[0]:
+      self.segments.pop(0)
+    seg = np.array(self.segments)
+    i = np.clip(np.searchsorted(seg[:,0], t, side='right') - 1, 0, len(seg)-1)
+    start, end, kind, x0, y0, x1, y1 = seg[i].T
+    p = np.clip((t - start) / (end - start), 0, 1)
+    p = 0.5 - 0.5*np.cos(np.pi*p)
+    x = x0 + (x1-x0)*p
+    y = y0 + (y1-y0)*p
+    n = len(t)
+    data = np.zeros((n, len(gaze_columns)))
+    data[:,0] = t
+    blink = kind == self.BLINK
+    for col, offset in ((1, -1.5), (4, 1.5)):
+      data[:,col]   = x + offset + self.rng.normal(0, self.noise, n)
+      data[:,col+1] = y + self.rng.normal(0, self.noise, n)
+      data[:,col+2] = np.where(blink, 0, 40 + self.rng.normal(0, 0.5, n))
+      data[blink,col:col+2] = np.nan
+    data[:,8] = data[:,9] = blink
+    data[:,11] = data[:,12] = kind == self.FIXATION
+    data[:,13] = data[:,14] = kind == self.SACCADE
+    data[:,16:20] = data[:,[1, 2, 4, 5]]
+    self.latest = data[-1]
+    if self.recording:
+      self.buffer.append(data)
+      self.unread += n
+      # The device buffer is circular, i.e. unread data is overwritten:
+      if self.unread > self.buffer_frames:
+        self.overflows += self.unread - self.buffer_frames
+        self.take(self.unread - self.buffer_frames)
+
+# Replaces the TRACKPixx3 with a simulated one.  Call before the
+# experiment starts.  Keyword arguments are passed on to
+# SimulatedTRACKPixx.
+def use_simulated_tracker(**kwargs):
+  global dp
+  dp = SimulatedTRACKPixx(**kwargs)
+  return dp
+
 #
 # TPxSimpleCalibration.py
 # 
 
-from pypixxlib import _libdpx as dp
-from psychopy import visual, iohub, core
-import numpy as np
-import PIL
+# Only needed for calibrating a real tracker:
+try:
+  from psychopy import visual, iohub, core
+  import PIL
+except ImportError:
+  pass
 
 def TPxSimpleCalibration(skipCameraSetup=False):
 
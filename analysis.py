@@ -0,0 +1,573 @@
+
+# Offline analysis of sessions recorded with Chamois and TPx.py.  Unlike
+# chamois.py and TPx.py, this is a regular Python module that needs
+# neither a display nor the eye-tracker:
+#
+#   import analysis
+#   fixations = analysis.session_fixations("data/20240912_082813_log.tsv")
+#
+# or from the command line for all sessions in data/:
+#
+#   python analysis.py fixations --method idt
+
+import os, re, glob, argparse, functools, hashlib, zlib, collections
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+# The format of the session log and the gaze data, shared with chamois.py:
+from logformat import log_columns, gaze_columns, log_index_filename, session_name, \
+                      read_index, read_log, parse_metrics, read_gaze, is_gaze_ref, \
+                      session_tables, write_tables
+
+# Columns of the samples of each eye: x, y, blink, fixation flag
+eye_columns = {"left": (1, 2, 8, 11), "right": (4, 5, 9, 12)}
+
+# Default parameters of the event detection.  Thresholds are in degrees
+# of visual angle and converted with pixels_per_degree (about 40 for a
+# 24" full HD screen at 70 cm).
+detection_defaults = {
+  "ivt": {"velocity_threshold": 30, "min_duration": 0.06, "velocity_window": 0.01},
+  "idt": {"dispersion_threshold": 1.0, "min_duration": 0.1},
+  "flags": {"min_duration": 0.06},
+}
+
+# Loads one table ("pages", "aois", or "metrics") of a dataset written
+# by export_session in chamois.py, for all sessions at once:
+def load_dataset(table, dataset_dir="data/dataset"):
+  directory = os.path.join(dataset_dir, table)
+  if glob.glob(os.path.join(directory, "*.parquet")):
+    return pd.read_parquet(directory)
+  frames = []
+  for filename in sorted(glob.glob(os.path.join(directory, "*.npz"))):
+    with np.load(filename) as data:
+      frames.append(pd.DataFrame({k: data[k] for k in data.files}))
+  return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+# Start (inclusive) and end (exclusive) indices of the runs of true
+# values in a boolean array:
+def runs(mask):
+  d = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+  return np.flatnonzero(d == 1), np.flatnonzero(d == -1)
+
+# Sets samples within padding seconds of a blink to true as well, since
+# the position is unreliable while the lid closes and opens:
+def pad_mask(mask, samples):
+  if samples <= 0 or not mask.any():
+    return mask
+  starts, ends = runs(mask)
+  delta = np.zeros(len(mask)+1, dtype=np.int32)
+  np.add.at(delta, np.maximum(starts - samples, 0), 1)
+  np.add.at(delta, np.minimum(ends + samples, len(mask)), -1)
+  return np.cumsum(delta[:-1]) > 0
+
+# Returns time and gaze position of one eye or the average of both eyes
+# ("both").  Samples during blinks (plus padding) are NaN.  With both
+# eyes, the other eye is used while one eye is blinking or lost.
+def gaze_signal(data, eye="both", blink_padding=0.05):
+  t = data[:,0]
+  period = np.median(np.diff(t)) if len(t) > 1 else 0
+  padding = int(round(blink_padding/period)) if period > 0 else 0
+  def one(eye):
+    xcol, ycol, blinkcol, _ = eye_columns[eye]
+    blink = pad_mask(data[:,blinkcol] > 0, padding)
+    return np.where(blink, np.nan, data[:,xcol]), np.where(blink, np.nan, data[:,ycol])
+  if eye != "both":
+    return (t, *one(eye))
+  (lx, ly), (rx, ry) = one("left"), one("right")
+  x = np.where(np.isnan(lx), rx, np.where(np.isnan(rx), lx, (lx+rx)/2))
+  y = np.where(np.isnan(ly), ry, np.where(np.isnan(ry), ly, (ly+ry)/2))
+  return t, x, y
+
+# Velocity-threshold identification: samples slower than the threshold
+# (degrees per second) belong to fixations.  At high sampling rates, the
+# velocity between neighbouring samples is dominated by noise, so it is
+# computed between the samples velocity_window seconds apart (centered).
+# Returns start and end indices of the fixations.
+def ivt(t, x, y, pixels_per_degree=40, velocity_threshold=30, min_duration=0.06, velocity_window=0.01):
+  if len(t) < 3:
+    return np.array([], dtype=int), np.array([], dtype=int)
+  k = max(1, int(round(velocity_window / np.median(np.diff(t)) / 2)))
+  k = min(k, (len(t)-1) // 2)
+  i = np.clip(np.arange(len(t)), k, len(t)-1-k)
+  dt = t[i+k] - t[i-k]
+  velocity = np.hypot(x[i+k] - x[i-k], y[i+k] - y[i-k]) / dt / pixels_per_degree
+  with np.errstate(invalid="ignore"):
+    starts, ends = runs(velocity < velocity_threshold)
+  keep = t[ends-1] - t[starts] >= min_duration
+  return starts[keep], ends[keep]
+
+# Dispersion-threshold identification (Salvucci & Goldberg, 2000): a
+# fixation is a window of at least min_duration in which the horizontal
+# plus the vertical extent of the samples is below the threshold
+# (degrees).  The windows of minimal length are checked for all samples
+# at once; only the expansion of the windows that pass is done per
+# fixation.  Returns start and end indices of the fixations.
+def idt(t, x, y, pixels_per_degree=40, dispersion_threshold=1.0, min_duration=0.1):
+  none = np.array([], dtype=int), np.array([], dtype=int)
+  if len(t) < 2:
+    return none
+  w = max(2, int(round(min_duration / np.median(np.diff(t)))))
+  if len(t) < w:
+    return none
+  threshold = dispersion_threshold * pixels_per_degree
+  xs, ys = sliding_window_view(x, w), sliding_window_view(y, w)
+  with np.errstate(invalid="ignore"):
+    ok = (xs.max(1) - xs.min(1)) + (ys.max(1) - ys.min(1)) <= threshold
+  okstarts = np.flatnonzero(ok)
+  # Samples covered by at least one window that passed:
+  delta = np.zeros(len(t)+1, dtype=np.int32)
+  delta[okstarts] += 1
+  delta[okstarts + w] -= 1
+  starts, ends = [], []
+  for s, e in zip(*runs(np.cumsum(delta[:-1]) > 0)):
+    # Greedy expansion from each window that passed:
+    while True:
+      k = np.searchsorted(okstarts, s)
+      if k == len(okstarts) or okstarts[k] >= e:
+        break
+      s = okstarts[k]
+      xa, ya = x[s:e], y[s:e]
+      d = (np.maximum.accumulate(xa) - np.minimum.accumulate(xa)
+           + np.maximum.accumulate(ya) - np.minimum.accumulate(ya))
+      over = np.flatnonzero(d > threshold)
+      j = over[0] if len(over) else e - s
+      starts.append(s)
+      ends.append(s + j)
+      s += j
+  return np.array(starts, dtype=int), np.array(ends, dtype=int)
+
+# Fixations as classified by the tracker itself (FixationFlag columns).
+# This is the fastest method since it needs no computation per sample.
+# With both eyes, both have to be flagged.
+def flag_fixations(data, eye="both", min_duration=0.06):
+  t = data[:,0]
+  eyes = ["left", "right"] if eye == "both" else [eye]
+  mask = np.logical_and.reduce([data[:,eye_columns[e][3]] > 0 for e in eyes])
+  starts, ends = runs(mask)
+  keep = t[ends-1] - t[starts] >= min_duration
+  return starts[keep], ends[keep]
+
+# Detects fixations in the samples of one trial and returns a table with
+# start and end (TimeTag, seconds), duration (ms), mean position
+# (tracker coordinates, pixels), and number of valid samples.
+def detect_fixations(data, method="ivt", eye="both", pixels_per_degree=40, blink_padding=0.05, **params):
+  params = {**detection_defaults[method], **params}
+  t, x, y = gaze_signal(data, eye, blink_padding)
+  if method == "ivt":
+    starts, ends = ivt(t, x, y, pixels_per_degree, **params)
+  elif method == "idt":
+    starts, ends = idt(t, x, y, pixels_per_degree, **params)
+  elif method == "flags":
+    starts, ends = flag_fixations(data, eye, **params)
+  else:
+    raise ValueError(f"Unknown method: {method}")
+  # Means over the valid samples of each fixation via cumulative sums:
+  valid = ~np.isnan(x)
+  n  = np.concatenate(([0], np.cumsum(valid)))
+  cx = np.concatenate(([0], np.cumsum(np.where(valid, x, 0))))
+  cy = np.concatenate(([0], np.cumsum(np.where(valid, y, 0))))
+  count = n[ends] - n[starts]
+  with np.errstate(invalid="ignore", divide="ignore"):
+    return pd.DataFrame({
+      "start":    t[starts],
+      "end":      t[ends-1],
+      "duration": 1000*(t[ends-1] - t[starts]),
+      "x":        (cx[ends] - cx[starts]) / count,
+      "y":        (cy[ends] - cy[starts]) / count,
+      "samples":  count})
+
+# The rows of the pages with eye-tracking data:
+def gaze_trials(rows):
+  return [row for row in rows if row[1] not in ("Message", "Metrics") and is_gaze_ref(row[10])]
+
+# Drift corrections (tracker coordinates) that were applied to the live
+# gaze during the trials, by page number (offset_x and offset_y in the
+# Metrics rows, see TPxDriftCheck):
+def drift_offsets(rows):
+  offsets = {}
+  for row in rows:
+    if row[1] == "Metrics" and "offset_x=" in (row[9] or ""):
+      m = dict(parse_metrics(row[9]))
+      offsets[row[0]] = (float(m["offset_x"]), float(m["offset_y"]))
+  return offsets
+
+# Fixations of all eye-tracking trials of a session, with the drift
+# correction of each trial applied.  Keyword arguments are passed on to
+# detect_fixations.
+def session_fixations(log_filename, rows=None, **kwargs):
+  data_dir = os.path.dirname(log_filename)
+  session = session_name(log_filename)
+  rows = rows or read_log(log_filename)
+  offsets = drift_offsets(rows)
+  tables = []
+  for row in gaze_trials(rows):
+    pno, ptype, item, condition, ref = row[0], row[1], row[4], row[5], row[10]
+    f = detect_fixations(read_gaze(ref, data_dir), **kwargs)
+    dx, dy = offsets.get(pno, (0, 0))
+    f["x"] -= dx
+    f["y"] -= dy
+    f.insert(0, "fixation", np.arange(len(f)))
+    f.insert(0, "condition", condition)
+    f.insert(0, "item", item)
+    f.insert(0, "type", ptype)
+    f.insert(0, "pno", int(pno))
+    f.insert(0, "session", session)
+    tables.append(f)
+  return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+# Screen size (width, height) logged at the start of the session:
+def session_screen(rows):
+  for row in rows:
+    if row[1] == "Message":
+      m = re.search(r'screen=(\d+)x(\d+)', row[9])
+      if m:
+        return int(m[1]), int(m[2])
+  return None
+
+# AOIs from metadata1 of a ReadingTrial as an array of x1, y1, x2, y2:
+def parse_aois(metadata1):
+  return np.array(re.split('[,;]', metadata1.strip(";")), dtype=float).reshape(-1, 4)
+
+# Returns the index of the word on which each fixation landed (-1 for
+# none).  x and y are screen coordinates.  The words are on one line;
+# horizontally, each word's region extends to the start of the next
+# word, so that fixations on the spaces count towards the following
+# word.  Vertically, fixations within y_margin pixels above and below
+# the line are accepted (default: the height of the line), since the
+# vertical position is usually less accurate.
+def map_fixations(x, y, aois, y_margin=None):
+  if y_margin is None:
+    y_margin = (aois[:,3] - aois[:,1]).max()
+  word = np.searchsorted(aois[:,0], x, side="right") - 1
+  ok = (word >= 0) & (x < aois[-1,2]) & (y >= aois[:,1].min() - y_margin) & (y < aois[:,3].max() + y_margin)
+  return np.where(ok, word, -1)
+
+# Word-level reading measures from fixations that were mapped to words
+# (column word, see map_fixations) and a table with one row per word
+# (session, pno, word_index, …).  Measures (durations in ms):
+#
+# - ffd: first fixation duration (first pass)
+# - gd: gaze duration, sum of the first-pass fixations
+# - gopast: go-past time, sum of the fixations from the first
+#   first-pass fixation until the first fixation to the right of the word
+# - trt: total reading time
+# - nfix: number of fixations
+# - skipped: no fixation in first pass
+# - regression_out: first pass ended with a fixation on a word to the left
+# - regression_in: number of fixations coming from a word to the right
+#
+# The first pass on a word is the first run of consecutive fixations on
+# it, provided that no word to its right was fixated before.  All
+# measures are computed for all trials at once.
+def reading_measures(fixations, words):
+  f = fixations.sort_values(["session", "pno", "fixation"]).reset_index(drop=True)
+  trial = f.groupby(["session", "pno"], sort=False).ngroup().to_numpy()
+  w = f["word"].to_numpy()
+  d = f["duration"].to_numpy()
+  n = len(f)
+  new_trial = np.r_[True, trial[1:] != trial[:-1]]
+  trial_starts = np.flatnonzero(new_trial)
+  trial_end = np.r_[trial_starts[1:], n][trial]
+  # Rightmost word fixated so far and before each fixation:
+  cm = f.groupby(trial)["word"].cummax().to_numpy()
+  prior = np.r_[-1, cm[:-1]]
+  prior[new_trial] = -1
+  previous = np.r_[-1, w[:-1]]
+  previous[new_trial] = -1
+  run_start = new_trial | (w != previous)
+  run_starts = np.flatnonzero(run_start)
+  run_end = np.r_[run_starts[1:], n][np.cumsum(run_start) - 1]
+  csum = np.r_[0, np.cumsum(d)]
+  # First-pass runs:
+  s = np.flatnonzero(run_start & (w >= 0) & (prior < w))
+  e = run_end[s]
+  # cm is non-decreasing within a trial, so the first fixation to the
+  # right of the word can be found by binary search over all trials:
+  span = w.max() + 2 if n else 1
+  key = trial*span + cm + 1
+  exit = np.searchsorted(key, trial[s]*span + w[s] + 1, side="right")
+  after = w[np.minimum(e, n-1)]
+  first_pass = pd.DataFrame({
+    "session": f["session"].to_numpy()[s], "pno": f["pno"].to_numpy()[s],
+    "word_index": w[s], "ffd": d[s], "gd": csum[e] - csum[s],
+    "gopast": csum[exit] - csum[s],
+    "regression_out": (e < trial_end[s]) & (after >= 0) & (after < w[s])})
+  on_word = w >= 0
+  totals = (f[on_word].assign(regression_in=previous[on_word] > w[on_word])
+            .groupby(["session", "pno", "word"])
+            .agg(trt=("duration", "sum"), nfix=("duration", "size"), regression_in=("regression_in", "sum"))
+            .reset_index().rename(columns={"word": "word_index"}))
+  m = (words.merge(first_pass, on=["session", "pno", "word_index"], how="left")
+       .merge(totals, on=["session", "pno", "word_index"], how="left"))
+  m["skipped"] = m["ffd"].isna()
+  m["regression_out"] = m["regression_out"].astype("boolean")
+  for c in ("nfix", "regression_in"):
+    m[c] = m[c].fillna(0).astype(int)
+  return m
+
+# Reading measures of all ReadingTrials with eye-tracking data of a
+# session.  Gaze positions are converted from tracker coordinates
+# (origin in the center of the screen, y pointing up) to screen
+# coordinates using the screen size logged at the start of the session
+# (or the given screen size for sessions that didn't log it).  Keyword
+# arguments are passed on to detect_fixations.
+def session_measures(log_filename, screen=None, y_margin=None, **kwargs):
+  rows = read_log(log_filename)
+  screen = session_screen(rows) or screen
+  if not screen:
+    raise RuntimeError(f"Screen size unknown, please specify: {log_filename}")
+  width, height = screen
+  session = session_name(log_filename)
+  fixations = session_fixations(log_filename, rows, **kwargs)
+  words = []
+  if len(fixations):
+    fixations["word"] = -1
+    trials = fixations.groupby("pno").groups
+  for row in gaze_trials(rows):
+    pno, stimulus, metadata1 = int(row[0]), row[6], row[9]
+    if not metadata1:
+      continue
+    aois = parse_aois(metadata1)
+    tokens = stimulus.split()
+    if len(tokens) != len(aois):
+      print(f"Warning: Number of words and AOIs differ in {session}, page {pno}.")
+      continue
+    words.append(pd.DataFrame({"session": session, "pno": pno, "item": row[4],
+                               "condition": row[5], "word_index": np.arange(len(tokens)),
+                               "word": tokens}))
+    if len(fixations) and pno in trials:
+      i = trials[pno]
+      x = fixations.loc[i, "x"].to_numpy() + width/2
+      y = height/2 - fixations.loc[i, "y"].to_numpy()
+      fixations.loc[i, "word"] = map_fixations(x, y, aois, y_margin)
+  if not words:
+    return pd.DataFrame()
+  words = pd.concat(words, ignore_index=True)
+  if not len(fixations):
+    fixations = pd.DataFrame({"session": [], "pno": [], "fixation": [], "duration": [], "word": []})
+  fixations = fixations[fixations["pno"].isin(words["pno"])]
+  return reading_measures(fixations.astype({"word": int}), words)
+
+def session_logs(data_dir="data"):
+  return sorted(glob.glob(os.path.join(data_dir, "*_log.tsv")))
+
+# Fixations of all sessions in data_dir.  Sessions are processed in
+# parallel (processes=None uses all CPUs).
+def all_fixations(data_dir="data", processes=None, **kwargs):
+  with ProcessPoolExecutor(processes) as pool:
+    tables = list(pool.map(functools.partial(session_fixations, **kwargs), session_logs(data_dir)))
+  tables = [t for t in tables if len(t)]
+  return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+# Files a session's results depend on, with size and modification time:
+def session_inputs(log_filename):
+  prefix = log_filename[:-len("_log.tsv")]
+  files = [log_filename] + sorted(glob.glob(prefix + "_gaze.bin")) + sorted(glob.glob(prefix + "_*.csv"))
+  return [(os.path.basename(f), os.path.getsize(f), os.path.getmtime(f)) for f in files]
+
+def cached_session_measures(log_filename, cache_file, kwargs):
+  m = session_measures(log_filename, **kwargs)
+  for old in glob.glob(os.path.join(os.path.dirname(cache_file), session_name(log_filename) + "_measures_*.pkl")):
+    os.remove(old)
+  m.to_pickle(cache_file)
+  return m
+
+# Reading measures of all sessions in data_dir.  The results of each
+# session are cached in cache_dir (default: data_dir/cache) under a key
+# that depends on the session's files (size, modification time) and the
+# parameters, so that reruns only process new or changed sessions.  The
+# remaining sessions are processed in parallel.
+def all_measures(data_dir="data", processes=None, cache_dir=None, **kwargs):
+  cache_dir = cache_dir or os.path.join(data_dir, "cache")
+  os.makedirs(cache_dir, exist_ok=True)
+  tables, todo = [], []
+  for log in session_logs(data_dir):
+    key = hashlib.sha1(repr((session_inputs(log), sorted(kwargs.items()))).encode()).hexdigest()[:16]
+    cache_file = os.path.join(cache_dir, f"{session_name(log)}_measures_{key}.pkl")
+    if os.path.exists(cache_file):
+      tables.append(pd.read_pickle(cache_file))
+    else:
+      todo.append((log, cache_file))
+  if todo:
+    print(f"Processing {len(todo)} new or changed session(s), {len(tables)} cached.")
+    with ProcessPoolExecutor(processes) as pool:
+      tables += pool.map(cached_session_measures, *zip(*todo), [kwargs]*len(todo))
+  tables = [t for t in tables if len(t)]
+  return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+#
+# Aggregation of many sessions
+#
+
+# Checks that a session log has the layout written by run_experiment
+# and that it matches its index.  Returns a list of problems (empty if
+# the log is fine).
+def validate_log(filename, rows):
+  problems = []
+  with open(filename, "rb") as f:
+    data = f.read()
+  header = ("\t".join(log_columns) + "\n").encode()
+  if not data.startswith(header):
+    return ["unexpected columns"]
+  index = log_index_filename(filename)
+  if os.path.exists(index):
+    end = len(header)
+    entries, skipped = read_index(index)
+    for k, (offset, length, crc) in enumerate(entries):
+      if offset != end or zlib.crc32(data[offset:offset+length]) != crc:
+        problems.append(f"row {k+1} doesn't match the index (see recover_log)")
+        break
+      end = offset + length
+    if skipped and not problems:
+      problems.append(f"incomplete line {len(entries)+1} in the index (see recover_log)")
+    if end != len(data) and not problems:
+      problems.append("data after the last indexed row (see recover_log)")
+  for k, row in enumerate(rows):
+    if len(row) != len(log_columns):
+      problems.append(f"row {k+1}: {len(row)} columns instead of {len(log_columns)}")
+      continue
+    if not row[0].isdigit():
+      problems.append(f"row {k+1}: pno is not a number: {row[0]!r}")
+    if not re.fullmatch(r'[A-Za-z_]\w*', row[1]):
+      problems.append(f"row {k+1}: invalid type: {row[1]!r}")
+    for c in (2, 3):
+      if row[c] and not re.fullmatch(r'-?\d+(\.\d+)?', row[c]):
+        problems.append(f"row {k+1}: {log_columns[c]} is not a number: {row[c]!r}")
+  return problems
+
+# Properties of a session needed for the index and the Latin square
+# report:
+def session_summary(rows):
+  info = {"latin_square_list": "", "completed": False, "simulated": False, "rows": len(rows)}
+  for row in rows:
+    if len(row) != len(log_columns) or row[1] != "Message":
+      continue
+    m = re.search(r'latin_square_list=([^;]*)', row[9])
+    if m:
+      info["latin_square_list"] = m[1]
+    if row[9].startswith("Session completed"):
+      info["completed"] = True
+      info["simulated"] = "simulated_participant=True" in row[9]
+  return info
+
+def aggregate_session(log_filename, dataset_dir):
+  session = session_name(log_filename)
+  rows = read_log(log_filename)
+  problems = validate_log(log_filename, rows)
+  if not problems:
+    write_tables(session_tables(session, rows), dataset_dir, session)
+  return {**session_summary(rows), "problems": "; ".join(problems)}
+
+def file_hash(filename):
+  with open(filename, "rb") as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
+index_columns = ["session", "file", "size", "mtime", "sha1", "rows", "latin_square_list", "completed", "simulated", "problems"]
+
+# Adds all new or changed session logs in data_dir to the dataset in
+# dataset_dir (layout as in export_session).  dataset_dir/index.tsv
+# records for each processed log its size, modification time, and hash.
+# Logs whose size and modification time are unchanged are skipped
+# without reading them; logs that were only touched are recognized by
+# their hash.  The remaining logs are validated and converted in
+# parallel.  Invalid logs are recorded in the index with their problems
+# but not added to the dataset.  Returns the index.
+def aggregate(data_dir="data", dataset_dir=None, processes=None):
+  dataset_dir = dataset_dir or os.path.join(data_dir, "dataset")
+  os.makedirs(dataset_dir, exist_ok=True)
+  index_file = os.path.join(dataset_dir, "index.tsv")
+  if os.path.exists(index_file):
+    index = pd.read_csv(index_file, sep="\t", dtype={"session": str, "latin_square_list": str}, keep_default_na=False)
+  else:
+    index = pd.DataFrame(columns=index_columns)
+  known = {row.session: row for row in index.itertuples()}
+  entries, todo = {}, []
+  for log in session_logs(data_dir):
+    session = session_name(log)
+    stat = os.stat(log)
+    old = known.get(session)
+    if old is not None and (old.size, old.mtime) == (stat.st_size, stat.st_mtime):
+      entries[session] = old._asdict()
+      continue
+    sha1 = file_hash(log)
+    if old is not None and old.sha1 == sha1:
+      entries[session] = {**old._asdict(), "size": stat.st_size, "mtime": stat.st_mtime}
+      continue
+    entries[session] = {"session": session, "file": os.path.basename(log), "size": stat.st_size,
+                        "mtime": stat.st_mtime, "sha1": sha1}
+    todo.append(log)
+  if todo:
+    print(f"Adding {len(todo)} new or changed session(s) to {dataset_dir} ({len(entries) - len(todo)} unchanged).")
+    with ProcessPoolExecutor(processes) as pool:
+      for log, result in zip(todo, pool.map(aggregate_session, todo, [dataset_dir]*len(todo))):
+        entries[session_name(log)].update(result)
+  for session in set(known) - set(entries):
+    print(f"Warning: Log of session {session} is gone but its data is still in {dataset_dir}.")
+  index = pd.DataFrame(list(entries.values()))[index_columns] if entries else pd.DataFrame(columns=index_columns)
+  index.to_csv(index_file + ".tmp", sep="\t", index=False)
+  os.replace(index_file + ".tmp", index_file)
+  for row in index[index["problems"] != ""].itertuples():
+    print(f"Warning: Session {row.session} not added: {row.problems}")
+  return index
+
+# Number of completed sessions per Latin square list according to the
+# logs (without simulated participants) and according to
+# tested_latin_square_lists.txt, the file used by
+# next_latin_square_list_label.
+def latin_square_report(index, tested_file="tested_latin_square_lists.txt"):
+  real = index[index["completed"].astype(bool) & ~index["simulated"].astype(bool) & (index["latin_square_list"] != "")]
+  logs = collections.Counter(real["latin_square_list"])
+  tested = collections.Counter()
+  if os.path.exists(tested_file):
+    with open(tested_file) as f:
+      tested = collections.Counter(line.strip() for line in f if line.strip())
+  incomplete = collections.Counter(index.loc[~index["completed"].astype(bool) & (index["latin_square_list"] != ""), "latin_square_list"])
+  lists = sorted(set(logs) | set(tested) | set(incomplete))
+  return pd.DataFrame({"list": lists,
+                       "completed_sessions": [logs[l] for l in lists],
+                       "incomplete_sessions": [incomplete[l] for l in lists],
+                       "tested_file": [tested[l] for l in lists],
+                       "difference": [tested[l] - logs[l] for l in lists]})
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Analysis of Chamois sessions.")
+  parser.add_argument("--data", default="data", help="directory with the session logs and gaze data")
+  parser.add_argument("--processes", type=int, default=None, help="number of parallel processes (default: all CPUs)")
+  commands = parser.add_subparsers(dest="command", required=True)
+  p = commands.add_parser("fixations", help="detect fixations in all sessions")
+  p.add_argument("--method", choices=list(detection_defaults), default="ivt")
+  p.add_argument("--eye", choices=["both", "left", "right"], default="both")
+  p.add_argument("--pixels-per-degree", type=float, default=40)
+  p.add_argument("--output", default="fixations.tsv")
+  p = commands.add_parser("measures", help="compute word-level reading measures for all sessions")
+  p.add_argument("--method", choices=list(detection_defaults), default="ivt")
+  p.add_argument("--eye", choices=["both", "left", "right"], default="both")
+  p.add_argument("--pixels-per-degree", type=float, default=40)
+  p.add_argument("--screen", help="screen size (e.g. 1920x1080) for sessions that didn't log it")
+  p.add_argument("--output", default="measures.tsv")
+  p = commands.add_parser("aggregate", help="add new or changed sessions to the consolidated dataset")
+  p.add_argument("--dataset", help="dataset directory (default: <data>/dataset)")
+  p.add_argument("--tested-lists", default="tested_latin_square_lists.txt")
+  args = parser.parse_args(argv)
+  if args.command == "fixations":
+    f = all_fixations(args.data, args.processes, method=args.method, eye=args.eye,
+                      pixels_per_degree=args.pixels_per_degree)
+    f.to_csv(args.output, sep="\t", index=False)
+    print(f"{len(f)} fixations stored in: {args.output}")
+  elif args.command == "measures":
+    screen = tuple(int(v) for v in args.screen.split("x")) if args.screen else None
+    m = all_measures(args.data, args.processes, method=args.method, eye=args.eye,
+                     pixels_per_degree=args.pixels_per_degree, screen=screen)
+    m.to_csv(args.output, sep="\t", index=False)
+    print(f"Measures for {len(m)} words stored in: {args.output}")
+  elif args.command == "aggregate":
+    index = aggregate(args.data, args.dataset, args.processes)
+    print(f"{(index['problems'] == '').sum()} sessions in the dataset.\n\nLatin square lists:")
+    report = latin_square_report(index, args.tested_lists)
+    print(report.to_string(index=False))
+    if (report["difference"] != 0).any():
+      print(f"Warning: Completed sessions in the logs and {args.tested_lists} differ.")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+# Runs TPxReadingTrials with a simulated participant and a simulated
+# TRACKPixx3 and reports gaze sampling, trigger, display change, and
+# storage performance.  Neither an eye-tracker nor a human is needed
+# (but a display, e.g. Xvfb).  Usage: ./benchmark_tpx.py [number of trials]
+
+# Load Chamois:
+exec(open("chamois.py").read())
+# Load TRACKPixx3 support:
+exec(open("TPx.py").read())
+
+ntrials = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+take_screenshots = False
+
+sentences = [
+  "While Bill hunted the deer that was brown and nimble was hunted by Bill.",
+  "Anna studied with the chef of the aristocrats who was routinely letting food go to waste.",
+  "Colorless green ideas sleep furiously.",
+  "No head injury is too trivial to be ignored.",
+]
+
+# Simulated eye-tracker with 2 kHz sampling:
+tracker = use_simulated_tracker(rate=2000)
+tpx = TPx()
+
+# Every other trial is a boundary trial with the third word masked:
+pages = []
+for i in range(ntrials):
+  s = random.choice(sentences)
+  if i % 2:
+    pages.append(TPxBoundaryTrial(i+1, "boundary", s, tpx, 2, "x"*len(s.split()[2])))
+  else:
+    pages.append(TPxReadingTrial(i+1, "benchmark", s, tpx))
+run_experiment(pages, participant=SimulatedParticipant(time_scale=0, visible=False))
+
+# Summary of the metrics in the session log:
+metrics = {}
+for row in read_log(f"data/{session_id}_log.tsv"):
+  if row[1] == "Metrics":
+    for name, value in parse_metrics(row[9]):
+      # Latencies and counts only, not points in time:
+      if value != "NA" and not name.endswith("_time"):
+        metrics.setdefault(name, []).append(float(value))
+print(f"\n{'metric':22} {'mean':>10} {'max':>10}")
+for name, values in metrics.items():
+  print(f"{name:22} {sum(values)/len(values):10.1f} {max(values):10.1f}")
+d = tpx.store.worker.durations
+print(f"{'gaze write (ms)':22} {1000*sum(d)/len(d):10.2f} {1000*max(d):10.2f}")
+print(f"Samples lost to buffer overflows: {tracker.overflows}")
@@ -1,23 +1,147 @@
 
 from FreeSimpleGUI import *
+from FreeSimpleGUI import _get_hidden_master_root
 theme('Default1')
 
-import time, random, re, math, os, sys, re, csv, subprocess
+import time, random, re, math, os, sys, re, csv, subprocess, queue, threading, zlib, json, contextlib, statistics, hashlib, itertools
+import tkinter, tkinter.font, socket
 from collections import Counter
 from datetime import datetime
 
+# Pillow is optional.  Without it, screenshots are taken with scrot
+# which blocks until the PNG file is written.
+try:
+  from PIL import ImageGrab
+except ImportError:
+  ImageGrab = None
+
+# Columns of the session log and the gaze data, read_log, the columnar
+# export, etc. are shared with analysis.py:
+exec(open("logformat.py").read())
+
 font = "Courier"
 fontsize = 22
 wordspacing = 18
+take_screenshots = True
+screenshot_queue_size = 16
+log_flush_every = 1
+log_fsync_every = 10
 latin_square_list_label = None
+latin_square_file = "tested_latin_square_lists.txt"
+latin_square_state_file = "latin_square_state.json"
+latin_square_reservation_ttl = 4*60*60
+tracing = False
+export_dataset = None
+recycle_widgets = True
+word_slots = 30
+viewing_distance = None
+screen_width_cm = None
+fixation_cross_size = None
+
+# The session ID is composed of the date and time at which the
+# experiment was started.  The random number generator is seeded with a
+# seed that is stored with the session, so that the order of the
+# stimuli can be reproduced when an aborted session is resumed (see
+# resume_session).
+session_id = datetime.today().strftime('%Y%m%d_%H%M%S')
+session_info = {"session_seed": random.randrange(2**32)}
+random.seed(session_info["session_seed"])
+resumed_session = False
+
+# Functions that are called when the experiment ends, also when it was
+# aborted or crashed, e.g. for closing devices:
+cleanup_handlers = []
+
+# Tracing of the phases of each page (see README).  With tracing
+# enabled, every "with trace(name, page):" block records its start and
+# end (time.perf_counter_ns) and the thread it ran in.  At the end of the
+# session, the phases are exported as a trace file that can be opened in
+# chrome://tracing or ui.perfetto.dev, plus a summary table (see
+# export_trace).  When tracing is disabled, trace returns a shared no-op
+# context manager, so the cost is one function call per phase.
+trace_events = []
+trace_origin = time.perf_counter_ns()
+no_trace = contextlib.nullcontext()
+
+class TracePhase:
+  __slots__ = ("name", "page", "start")
+  def __init__(self, name, page):
+    self.name = name
+    self.page = page
+  def __enter__(self):
+    self.start = time.perf_counter_ns()
+  def __exit__(self, *exc):
+    # The page is stored rather than its number which may only be known
+    # after the phase (e.g. attach):
+    trace_events.append((self.name, self.page, threading.current_thread().name, self.start, time.perf_counter_ns()))
+
+def trace(name, page=None):
+  if not tracing:
+    return no_trace
+  return TracePhase(name, page)
+
+# Page times are measured with a monotonic high-resolution clock
+# (time.perf_counter) in seconds since the start of the session.  Unlike
+# the wall clock, it isn't affected by adjustments of the system time
+# during the session.  The wall-clock time of the start is logged in the
+# first Message row.
+exp_starttime = time.perf_counter()
+
+def session_time():
+  return time.perf_counter() - exp_starttime
 
 class ExperimentAbortException(Exception):
   pass
 
-class Page:
+# A set of widgets in a column of its own that can be added to the
+# window and removed again.  Pages are templates that are used once.
+# Pages of the same kind can also share a template that stays in the
+# window and is only refilled with the content of the next page (see
+# borrow_template).
+class Template:
+  def __init__(self, layout, **kwargs):
+    self.layout = layout
+    self.column = Column(layout, visible=False, expand_x=True, expand_y=True, **kwargs)
+  # Add the widgets to the window.  For a page, this happens just
+  # before the page is shown, so that only one page at a time exists in
+  # Tk.
+  def attach(self, window):
+    keys = set(window.AllKeysDict)
+    window.extend_layout(window['-PAGES-'], [[self.column]])
+    self.row = window.Rows[-1]
+    self.keys = set(window.AllKeysDict) - keys
+  # Destroy the widgets, e.g. once the page is completed:
+  def detach(self, window):
+    self.column.ParentRowFrame.destroy()
+    window.Rows.remove(self.row)
+    for k in self.keys:
+      del window.AllKeysDict[k]
+
+# Shared templates by name.  They belong to the window of the session
+# and are created when they are first needed, so that the number of Tk
+# widgets doesn't grow with the number of trials.  If fits(template) is
+# false, e.g. because a sentence has more words than the template has
+# slots, the template is replaced.
+templates = {}
+
+def borrow_template(window, name, make, fits=None):
+  template = templates.get(name)
+  if template and fits and not fits(template):
+    template.detach(window)
+    template = None
+  if not template:
+    template = templates[name] = make()
+    template.attach(window)
+  return template
+
+# Pages without layout (None) get their widgets when they are attached,
+# e.g. from a shared template (see ReadingTrial).
+class Page(Template):
   def __init__(self, layout, **kwargs):
-    self.layout     = layout
-    self.column     = Column(layout, visible=False, expand_x=True, expand_y=True, **kwargs)
+    self.layout = layout
+    self.column = None
+    if layout is not None:
+      super().__init__(layout, **kwargs)
     self.event      = None
     self.values     = None
     self.completed  = False
@@ -32,11 +156,12 @@ class Page:
     self.screenshot = None
     self.metadata1  = None
     self.metadata2  = None
+    self.metrics    = {}
   # Activate the page as defined at creation.
   def activate(self, window, pno):
     self.column.update(visible=True)
     self.pno = pno
-    self.starttime = round(time.time() - exp_starttime, 3)
+    self.starttime = session_time()
     # Print message in terminal:
     stim_abbrev = self.stimulus or ""
     stim_abbrev = stim_abbrev.replace("\n", "")
@@ -49,12 +174,15 @@ class Page:
     else:
       print("%d, %s" % (self.pno, self.type))
     # Let's go:
-    self.prelude(window)
-    self.handle_event(window)
+    with trace("prelude", self):
+      self.prelude(window)
+    with trace("handle_event", self):
+      self.handle_event(window)
   # Optional stage-setting that can only be performed once the page is
   # displayed:
   def prelude(self, window):
-    window.refresh()
+    with trace("refresh", self):
+      window.refresh()
   def handle_event(self, window):
     while True:
       self.event, self.values = window.read()
@@ -64,13 +192,20 @@ class Page:
         break
     self.deactivate()
   def deactivate(self):
-    self.endtime = round(time.time() - exp_starttime, 3)
-    self.column.update(visible=False)
+    self.endtime = session_time()
+    with trace("hide", self):
+      self.column.update(visible=False)
     self.completed = True
   def get_data(self):
     if not self.completed:
       raise RuntimeError("Trying to retrieve results from a page that hasn't completed.")
-    return (self.pno, self.type, f"{self.starttime:.3f}", f"{self.endtime:.3f}", self.item, self.condition, self.stimulus, self.response, self.screenshot, self.metadata1, self.metadata2)
+    return (self.pno, self.type, f"{self.starttime:.6f}", f"{self.endtime:.6f}", self.item, self.condition, self.stimulus, self.response, self.screenshot, self.metadata1, self.metadata2)
+  # Measurements such as latencies go into a separate row of type
+  # "Metrics" following the page's row, so that the columns of the page
+  # keep their meaning.  Format: name=value;name=value;…
+  def get_metrics(self):
+    metrics = ";".join(f"{k}={v}" for k,v in self.metrics.items())
+    return (self.pno, "Metrics", f"{self.starttime:.6f}", f"{self.endtime:.6f}", self.item, self.condition, None, None, None, metrics, None)
 
 # Message shares an interface with Page but is not itself a page since
 # it is not part of the GUI.
@@ -82,10 +217,9 @@ class Message:
     self.starttime = None
   def activate(self, _, pno):
     self.pno = pno
-    self.starttime = round(time.time() - exp_starttime, 3)
+    self.starttime = session_time()
   def get_data(self):
-    # TODO: Make sure to show 3 digits in start and endtime.
-    return (self.pno, self.type, f"{self.starttime:.3f}", None, None, None, None, None, None, self.metadata1, None)
+    return (self.pno, self.type, f"{self.starttime:.6f}", None, None, None, None, None, None, self.metadata1, None)
 
 # Separate class to make a page show up in the results as
 # "Instructions".
@@ -123,29 +257,114 @@ class ConsentForm(Instructions):
     if len(text) > 40:
       self.stimulus = text[:40] + ' …'
 
+# Executes slow jobs (encoding images, writing files) in a separate
+# thread so that they don't delay the next page.  The queue is bounded:
+# if the worker falls behind, submit blocks until there is room again.
+class BackgroundWorker:
+  def __init__(self, name, maxsize):
+    self.queue     = queue.Queue(maxsize)
+    self.durations = []
+    self.thread    = threading.Thread(target=self.run, name=name, daemon=True)
+    self.thread.start()
+  # Returns the number of jobs that were still waiting:
+  def submit(self, job, *args):
+    depth = self.queue.qsize()
+    self.queue.put((job, args))
+    return depth
+  def run(self):
+    while True:
+      job, args = self.queue.get()
+      t = time.perf_counter()
+      try:
+        with trace(self.thread.name):
+          job(*args)
+      except Exception as e:
+        sys.stderr.write(f"Warning: Background job failed: {e}\n")
+      self.durations.append(time.perf_counter() - t)
+      self.queue.task_done()
+  # Blocks until all submitted jobs are done:
+  def drain(self):
+    self.queue.join()
+
 # Takes a screenshot before handling an event:
 class ExperimentalTrial(Page):
   def deactivate(self):
+    if not take_screenshots:
+      super().deactivate()
+      return
     self.screenshot = "%s_%03d_%s_%03d_%s.png" % (session_id, self.pno, self.type, self.item, self.condition)
-    try:
-      # Fails on wayland and is not accurate (some pixels horizontally
-      # offset):
-      # window.save_window_screenshot_to_disk(self.screenshot)
-
-      # Scrot also doesn't work on wayland but it's accurate:
-      subprocess.run(["scrot", "data/" + self.screenshot])
-    except:
-      sys.stderr.write(f"Warning: Screenshot failed: {self.screenshot}\n")
+    t = time.perf_counter()
+    with trace("screenshot", self):
+      try:
+        # Fails on wayland and is not accurate (some pixels horizontally
+        # offset):
+        # window.save_window_screenshot_to_disk(self.screenshot)
+
+        if ImageGrab:
+          # Only grab the pixels here.  Encoding and writing the PNG file
+          # happens in the background:
+          image = ImageGrab.grab()
+          self.metrics["screenshot_queue"] = screenshot_worker.submit(image.save, "data/" + self.screenshot)
+        else:
+          # Scrot also doesn't work on wayland but it's accurate:
+          subprocess.run(["scrot", "data/" + self.screenshot])
+      except:
+        sys.stderr.write(f"Warning: Screenshot failed: {self.screenshot}\n")
+    self.metrics["screenshot_latency"] = f"{1000*(time.perf_counter() - t):.1f}"
     super().deactivate()
 
-# TODO Specify size in visual field degrees (adapts to screen size,
-# distance, ...).
+# Size of one degree of visual angle in pixels (at the center of the
+# screen), given the viewing distance in cm.  The physical width of the
+# screen is taken from screen_width_cm or, if that isn't set, from the
+# display server (which isn't always accurate).
+def pixels_per_degree():
+  root = measuring_root()
+  width_px = root.winfo_screenwidth()
+  width_cm = screen_width_cm or root.winfo_screenmmwidth()/10
+  return 2 * viewing_distance * math.tan(math.radians(0.5)) * width_px / width_cm
+
+# Pixel sizes (width, height, outer radius, inner radius, line width) of
+# fixation crosses of a given size in degrees, cached by the size and
+# the screen geometry.  The proportions are those of the default cross.
+fixation_cross_sizes = {}
+
+def fixation_cross_pixels(degrees):
+  key = (degrees, viewing_distance, screen_width_cm)
+  if key not in fixation_cross_sizes:
+    if not viewing_distance:
+      raise RuntimeError("Sizes in degrees of visual angle require viewing_distance (cm).")
+    scale = degrees * pixels_per_degree() / 38
+    fixation_cross_sizes[key] = (round(38*scale), round(38*scale), 17*scale, 4*scale, max(1, round(7*scale)))
+  return fixation_cross_sizes[key]
+
+# Blink animation of the fixation cross: times (s, relative to the
+# start) at which the cross is shown and hidden, and the end of the
+# animation.  Every cycle is shorter than the one before.
+def blink_times(t=200):
+  schedule = []
+  end = 0
+  while t > 10:
+    schedule.append((end, end + (30+t)/1000))
+    end += (30+t)/1000 + (30+t/2)/1000
+    t *= 0.55
+  return schedule, end
+
+# The cross is drawn once, when it is first shown, and afterwards only
+# shown and hidden by changing the state of its canvas items.  The size
+# is given in pixels or, with degrees (default: fixation_cross_size), in
+# degrees of visual angle (see fixation_cross_pixels).
 class FixationCross(Graph):
-  def __init__(self, width=38, height=38, radius1=17, radius2=4):
+  blink_schedule, blink_end = blink_times()
+  def __init__(self, width=38, height=38, radius1=17, radius2=4, degrees=None):
+    self.line_width = 7
+    degrees = degrees or fixation_cross_size
+    if degrees:
+      width, height, radius1, radius2, self.line_width = fixation_cross_pixels(degrees)
     self.width   = width
     self.height  = height
     self.radius1 = radius1
     self.radius2 = radius2
+    self.rendered = False
     theme_properties = LOOK_AND_FEEL_TABLE[theme()]
     self.background_color = theme_properties['BACKGROUND']
     self.foreground_color = theme_properties['TEXT']
@@ -154,7 +373,7 @@ class FixationCross(Graph):
       graph_bottom_left = (-width/2, -height/2), 
       graph_top_right   = (width/2, height/2),
       background_color  = self.background_color)
-  def draw(self):
+  def render(self):
     r1 = self.radius1
     r2 = self.radius2
     # Draw the inner oval:
@@ -162,60 +381,198 @@ class FixationCross(Graph):
                    line_color=self.foreground_color,
                    fill_color=self.foreground_color)
     # Draw the cross using lines:
-    self.draw_line((r1*1.1, 0), (-r1*1.1, 0), width=7, color=self.background_color)
-    self.draw_line((0, r1*1.1), (0, -r1*1.1), width=7, color=self.background_color)
+    self.draw_line((r1*1.1, 0), (-r1*1.1, 0), width=self.line_width, color=self.background_color)
+    self.draw_line((0, r1*1.1), (0, -r1*1.1), width=self.line_width, color=self.background_color)
     # Draw the inner oval:
     self.draw_oval((r2, r2), (-r2, -r2),
                    line_color="red",
                    fill_color="red")
+    self.rendered = True
+  def show(self):
+    if not self.rendered:
+      self.render()
+    self.TKCanvas.itemconfigure("all", state="normal")
+  def hide(self):
+    self.TKCanvas.itemconfigure("all", state="hidden")
+  # Runs the blink animation on the clock (time.perf_counter) and
+  # returns the times at which the cross actually appeared and
+  # disappeared (drawing sent to the display server) as a list of
+  # (onset, offset).  The largest deviation from the schedule is stored
+  # in timing_error (s).  For simulated participants, the schedule is
+  # scaled with their time_scale.
   def blink(self, window):
-    t = 200
-    while t > 10:
-      self.draw()
-      window.read(timeout=30+t)
-      self.erase()
-      window.read(timeout=30+t/2)
-      t *= 0.55
+    scale = getattr(window, "time_scale", 1)
+    canvas = self.TKCanvas
+    times = []
+    start = time.perf_counter()
+    for on, off in self.blink_schedule:
+      wait_until(window, start + on*scale)
+      self.show()
+      canvas.update_idletasks()
+      onset = time.perf_counter()
+      wait_until(window, start + off*scale)
+      self.hide()
+      canvas.update_idletasks()
+      times.append((onset, time.perf_counter()))
+    wait_until(window, start + self.blink_end*scale)
+    self.timing_error = max(max(abs(onset - start - on*scale), abs(offset - start - off*scale))
+                            for (onset, offset), (on, off) in zip(times, self.blink_schedule))
+    return times
 
-class ReadingTrial(ExperimentalTrial):
-  def __init__(self, item, condition, text):
-    self.fixation_cross = fc = FixationCross()
+# Waits until the given time (time.perf_counter).  Events of the window
+# are processed in the meantime.  The last 2 ms are spent busy-waiting,
+# since timeouts of window.read aren't precise.
+def wait_until(window, deadline):
+  while True:
+    remaining = deadline - time.perf_counter()
+    if remaining <= 0:
+      return
+    if remaining > 0.002:
+      window.read(timeout=int(1000*(remaining - 0.002)))
+
+# Font metrics are measured in FreeSimpleGUI's hidden master root, so
+# that they are also available before the experiment window exists.
+# It has to be that root and not one of our own: the experiment window
+# is created in it, and FreeSimpleGUI creates the Tcl variables of its
+# elements in tkinter's default root, i.e. the first root that was
+# created.  Widths are cached by font, size, and word.
+text_widths = {}
+
+def measuring_root():
+  return _get_hidden_master_root()
+
+def measuring_font():
+  return tkinter.font.Font(root=measuring_root(), family=font, size=fontsize)
+
+def text_width(word):
+  key = (font, fontsize, word)
+  if key not in text_widths:
+    text_widths[key] = measuring_font().measure(word)
+  return text_widths[key]
+
+# Word boxes of a ReadingTrial (x1, y1, x2, y2) relative to the top left
+# corner of the first word.  Mirrors how Tk lays out the Text elements:
+# a label is 2 pixels (border and padding) wider than its text on each
+# side, and neighbouring labels are separated by their padding.
+word_layouts = {}
+
+def word_layout(text):
+  key = (font, fontsize, wordspacing, text)
+  if key not in word_layouts:
+    pad = 2 * int(wordspacing/2)
+    height = measuring_font().metrics("linespace") + 4
+    boxes = []
+    x = 0
+    for w in text.split():
+      width = text_width(w) + 4
+      boxes.append((x, 0, x+width, height))
+      x += width + pad
+    word_layouts[key] = boxes
+  return word_layouts[key]
+
+# Text elements show the value of a Tcl variable.  These functions go
+# through the label itself, so that the variable is always the one in
+# the label's interpreter, and skip the extra work of Text.update
+# (colors, fonts, visibility).
+def text_variable(element):
+  return str(element.widget.cget("textvariable"))
+
+def set_text(element, text):
+  element.widget.setvar(text_variable(element), text)
+
+# Estimated horizontal position of the first word of a ReadingTrial on
+# screen: window margin, paddings of the columns that contain the page,
+# fixation cross with its padding, and padding of the first word.
+def text_start():
+  return DEFAULT_MARGINS[0] + 4*DEFAULT_ELEMENT_PADDING[0] + FixationCross().width + int(wordspacing/2)
+
+# The widgets of a ReadingTrial: two fixation crosses and a row of
+# initially invisible slots for the words.
+class ReadingTemplate(Template):
+  def __init__(self, slots):
+    self.fixation_cross  = fc  = FixationCross()
     self.fixation_cross2 = fc2 = FixationCross()
-    self.words = [Text(w, pad=int(wordspacing/2), visible=False) for w in s.split()]
+    self.words = [Text("", pad=int(wordspacing/2), visible=False) for i in range(slots)]
     layout = [[VPush()],
               [fc] + self.words,
               [VPush()],
               [Push(), fc2]]
     super().__init__(layout, vertical_alignment="center")
+
+# With recycle_widgets=True, all ReadingTrials share one template with
+# at least word_slots slots.  Otherwise, every trial creates its own
+# widgets.
+class ReadingTrial(ExperimentalTrial):
+  def __init__(self, item, condition, text):
+    super().__init__(None)
+    self.text      = text
     self.item      = item
     self.condition = condition
     self.stimulus  = text
+  def attach(self, window):
+    words = self.text.split()
+    self.recycled = recycle_widgets
+    if self.recycled:
+      self.template = borrow_template(window, "ReadingTrial", lambda: ReadingTemplate(max(word_slots, len(words))),
+                                      lambda t: len(t.words) >= len(words))
+    else:
+      self.template = ReadingTemplate(len(words))
+      self.template.attach(window)
+    self.column          = self.template.column
+    self.fixation_cross  = self.template.fixation_cross
+    self.fixation_cross2 = self.template.fixation_cross2
+    self.words           = self.template.words[:len(words)]
+    for w, word in zip(self.words, words):
+      set_text(w, word)
+  def detach(self, window):
+    if self.recycled:
+      for w in self.words:
+        w.update(visible=False)
+      self.fixation_cross2.hide()
+    else:
+      self.template.detach(window)
   def prelude(self, window):
     # Blink fixation cross:
-    self.fixation_cross.blink(window)
+    with trace("blink", self):
+      blinks = self.fixation_cross.blink(window)
+    # One onset and offset per blink, numbered from 1, so that they stay
+    # numeric measurements in the metrics table:
+    for n, (onset, offset) in enumerate(blinks, 1):
+      self.metrics[f"fixation{n}_onset_time"] = f"{onset - exp_starttime:.6f}"
+      self.metrics[f"fixation{n}_offset_time"] = f"{offset - exp_starttime:.6f}"
+    self.metrics["blink_timing_error"] = f"{1000*self.fixation_cross.timing_error:.2f}"
     # Show words:
-    for w in self.words:
-      w.update(visible=True)
-    self.fixation_cross2.draw()
-    window.refresh()
-    # Calculate AOIs:
-    self.aois = []
-    for i,word in enumerate(self.words):
-      x, y = word.widget.winfo_rootx(), word.widget.winfo_rooty()
-      w, h = word.get_size()
-      self.aois.append(f'{x},{y},{x+w},{y+h}')
-    # Check whether text extends beyond screen (no exact science):
+    with trace("show_words", self):
+      for w in self.words:
+        w.update(visible=True)
+      self.fixation_cross2.show()
+      window.refresh()
+    with trace("aois", self):
+      boxes = self.measure_aois()
+    # Check whether text extends beyond screen:
     window_width, _ = window.size
-    first_word_length = len(self.words[0].get())
-    first_word_width = self.words[0].widget.winfo_width()
-    first_word_start = self.words[0].widget.winfo_rootx()
-    char_width = (first_word_width - 4) / first_word_length
-    last_word_end = first_word_start + char_width * len(''.join(self.stimulus.split())) + 4 * len(self.words) + wordspacing * (len(self.words)-1)
-    if (window_width < last_word_end):
+    if (window_width < boxes[-1][2]):
       time.sleep(1)
       raise RuntimeError("Text extends beyond window boundaries: " + self.stimulus)
     self.metadata1 = ";".join(self.aois)
     super().prelude(window)
+  # Calculate AOIs from the precomputed layout.  Only the first and the
+  # last word are measured to verify the layout:
+  def measure_aois(self):
+    boxes = word_layout(self.stimulus)
+    first, last = self.words[0].widget, self.words[-1].widget
+    x0, y0 = first.winfo_rootx(), first.winfo_rooty()
+    if (last.winfo_rootx() - x0, last.winfo_width(), last.winfo_height()) == (boxes[-1][0], boxes[-1][2] - boxes[-1][0], boxes[-1][3]):
+      boxes = [(x0+x1, y0+y1, x0+x2, y0+y2) for x1, y1, x2, y2 in boxes]
+    else:
+      sys.stderr.write("Warning: Layout differs from font metrics, measuring all words.\n")
+      boxes = []
+      for word in self.words:
+        x, y = word.widget.winfo_rootx(), word.widget.winfo_rooty()
+        w, h = word.get_size()
+        boxes.append((x, y, x+w, y+h))
+    self.aois = [f'{x1},{y1},{x2},{y2}' for x1, y1, x2, y2 in boxes]
+    return boxes
   def handle_event(self, window):
     while True:
       self.event, self.values = window.read()
@@ -229,17 +586,131 @@ class ReadingTrial(ExperimentalTrial):
         break
     self.deactivate()
 
-class YesNoQuestionTrial(ExperimentalTrial):
-  def __init__(self, item, condition, question):
+# Self-paced reading with a moving window: all words are masked (each
+# letter replaced by mask_character) and every press of the space bar
+# reveals the next region and masks the previous one (unless
+# cumulative=True).  By default, every word is a region of its own;
+# regions=[2, 1, 3, …] groups the words instead.  The labels of all
+# words are created and laid out once, with the width of their word,
+# so that a step only changes the text of a few Tk labels without any
+# relayout.  Reading times per region (ms) go into metadata2, and the
+# time from the key press to the updated display is logged as
+# display_latency (mean and maximum).
+class SelfPacedReadingTrial(ReadingTrial):
+  def __init__(self, item, condition, text, regions=None, mask_character="-", cumulative=False):
+    super().__init__(item, condition, text)
+    self.texts = text.split()
+    self.masks = [re.sub(r"\w", mask_character, w) for w in self.texts]
+    regions = regions or [1] * len(self.texts)
+    if sum(regions) != len(self.texts):
+      raise RuntimeError(f"Regions ({sum(regions)} words) don't match the sentence ({len(self.texts)} words): {text}")
+    starts = list(itertools.accumulate(regions, initial=0))
+    self.regions    = [range(i, j) for i, j in zip(starts, starts[1:])]
+    self.cumulative = cumulative
+  def prelude(self, window):
+    self.root = window.TKroot
+    # The labels display the values of Tcl variables:
+    self.text_vars = [text_variable(w) for w in self.words]
+    # With an image, the width of a Tk label is given in pixels, so
+    # the labels keep the width of their word also when masked:
+    self.blank = tkinter.PhotoImage(master=self.root, width=1, height=1)
+    for w, word, mask in zip(self.words, self.texts, self.masks):
+      w.widget.configure(image=self.blank, compound="center", width=text_width(word))
+      set_text(w, mask)
+    super().prelude(window)
+    # FreeSimpleGUI reports keys only when they are released, so the
+    # next region is shown by a binding of the key press, as soon as Tk
+    # dispatches it.  window.read only ends or aborts the trial.  Key
+    # presses during the fixation cross are ignored.
+    self.pressed  = []
+    self.shown    = []
+    self.key_held = False
+    self.release_time = None
+    self.key_bindings = [self.root.bind_all("<KeyPress-space>", self.key_press),
+                         self.root.bind_all("<KeyRelease-space>", self.key_release)]
+  def key_press(self, event):
+    # Auto-repeat of a held key: no release in between (Windows, macOS)
+    # or a release with the same time stamp (X11):
+    if self.key_held or event.time == self.release_time:
+      return
+    self.key_held = True
+    self.press(time.perf_counter())
+  def key_release(self, event):
+    self.key_held = False
+    self.release_time = event.time
+  # Shows the next region (if any) and records when the key was pressed
+  # and when the region was on the screen:
+  def press(self, t):
+    self.pressed.append(t)
+    if len(self.shown) < len(self.regions):
+      self.show_region(len(self.shown))
+      self.shown.append(time.perf_counter())
+  def show_region(self, i):
+    if i > 0 and not self.cumulative:
+      for k in self.regions[i-1]:
+        self.root.setvar(self.text_vars[k], self.masks[k])
+    for k in self.regions[i]:
+      self.root.setvar(self.text_vars[k], self.texts[k])
+    self.root.update_idletasks()
+  def handle_event(self, window):
+    while len(self.pressed) <= len(self.regions):
+      self.event, self.values = window.read()
+      if self.event == WIN_CLOSED:
+        raise ExperimentAbortException()
+      # Simulated key presses are only seen by window.read:
+      if self.event.startswith('space:') and isinstance(window, SimulatedParticipant):
+        self.press(time.perf_counter())
+      if self.event.startswith('Escape:'):
+        self.response = "ABORTED"
+        print("  Page aborted.")
+        break
+    pressed, shown = self.pressed, self.shown
+    self.metadata2 = ";".join(f"{1000*(p - s):.1f}" for s, p in zip(shown, pressed[1:]))
+    latencies = [s - p for p, s in zip(pressed, shown)]
+    if latencies:
+      self.metrics["display_latency"] = f"{1000*statistics.mean(latencies):.2f}"
+      self.metrics["display_latency_max"] = f"{1000*max(latencies):.2f}"
+    self.deactivate()
+  def deactivate(self):
+    self.root.unbind_all("<KeyPress-space>")
+    self.root.unbind_all("<KeyRelease-space>")
+    for binding in self.key_bindings:
+      self.root.deletecommand(binding)
+    super().deactivate()
+  # The labels may be reused by other trials (see ReadingTemplate):
+  def detach(self, window):
+    for w in self.words:
+      w.widget.configure(image="", width=0)
+    super().detach(window)
+
+class QuestionTemplate(Template):
+  def __init__(self):
+    self.question = Text("", pad=50)
     layout = [[VPush()],
-              [Text(q, pad=50)],
+              [self.question],
               [VPush()],
               [Text("[f] key for “no” — [j] key for “yes”", font=f"{font} {int(fontsize*0.7)}", text_color="grey79")]]
     super().__init__(layout, element_justification="center")
+
+class YesNoQuestionTrial(ExperimentalTrial):
+  def __init__(self, item, condition, question):
+    super().__init__(None)
     self.item      = item
     self.condition = condition
     self.stimulus  = question
     self.response  = None
+  def attach(self, window):
+    self.recycled = recycle_widgets
+    if self.recycled:
+      self.template = borrow_template(window, "YesNoQuestionTrial", QuestionTemplate)
+    else:
+      self.template = QuestionTemplate()
+      self.template.attach(window)
+    self.column = self.template.column
+    set_text(self.template.question, self.stimulus)
+  def detach(self, window):
+    if not self.recycled:
+      self.template.detach(window)
   def handle_event(self, window):
     while True:
       self.event, self.values = window.read()
@@ -287,28 +758,275 @@ class SubjectIDPage(Page):
     self.deactivate()
     self.response = self.values["-SUBJECTID-"]
 
-def run_experiment(pages):
-  global window, session_id, exp_starttime
-  session_id = datetime.today().strftime('%Y%m%d_%H%M%S')
+# Append-only session log.  Rows are written as soon as a page is
+# completed, so that a crash loses at most the current page.  Rows are
+# passed on to the operating system every flush_every rows (survives a
+# crash of Python) and forced to disk every fsync_every rows (survives
+# a power loss).  An index file records offset, length, and checksum
+# of each row.  Since stimuli may contain line breaks, this is the only
+# reliable way to tell where a partially written log ends (see
+# recover_log).
+class SessionLog:
+  def __init__(self, filename, flush_every=1, fsync_every=10):
+    self.filename    = filename
+    self.flush_every = flush_every
+    self.fsync_every = fsync_every
+    self.unflushed   = 0
+    self.unsynced    = 0
+    new = not os.path.exists(filename)
+    self.file  = open(filename, "ab")
+    self.index = open(log_index_filename(filename), "a")
+    if new:
+      self.file.write(('\t'.join(log_columns) + '\n').encode())
+      self.sync()
+  def write(self, row):
+    t = tuple(str(v) if v!=None else '' for v in row)
+    if t[0]=="Next":
+      return
+    line = ("\t".join(t) + "\n").encode()
+    self.index.write(f"{self.file.tell()}\t{len(line)}\t{zlib.crc32(line)}\n")
+    self.file.write(line)
+    self.unflushed += 1
+    self.unsynced += 1
+    if self.unflushed >= self.flush_every:
+      self.flush()
+    if self.unsynced >= self.fsync_every:
+      self.sync()
+  # The log is flushed before the index, so that the index never points
+  # to data that isn't there yet.
+  def flush(self):
+    self.file.flush()
+    self.index.flush()
+    self.unflushed = 0
+  def sync(self):
+    self.flush()
+    os.fsync(self.file.fileno())
+    os.fsync(self.index.fileno())
+    self.unsynced = 0
+  def close(self):
+    self.sync()
+    self.file.close()
+    self.index.close()
+
+# Checks a session log against its index and truncates both to the last
+# row that was completely written.  Returns the number of valid rows.
+def recover_log(filename):
+  with open(filename, "rb") as f:
+    data = f.read()
+  header = ('\t'.join(log_columns) + '\n').encode()
+  if not data.startswith(header):
+    raise RuntimeError(f"Not a session log or unknown columns: {filename}")
+  entries, skipped = read_index(log_index_filename(filename))
+  end = len(header)
+  n = 0
+  for offset, length, crc in entries:
+    if offset != end or zlib.crc32(data[offset:offset+length]) != crc:
+      break
+    end = offset + length
+    n += 1
+  if end < len(data) or n < len(entries) or skipped:
+    sys.stderr.write(f"Warning: Removing incomplete data at the end of {filename}\n")
+    with open(filename, "r+b") as f:
+      f.truncate(end)
+    with open(log_index_filename(filename), "w") as f:
+      f.writelines("%d\t%d\t%d\n" % e for e in entries[:n])
+  return n
+
+# Writes a row of type Message to the session log:
+def log_message(message, pno):
+  m = Message(message)
+  m.activate(None, pno)
+  session_log.write(m.get_data())
+
+# Waits until all screenshots are on disk and logs the time it took to
+# encode and store them:
+def screenshot_summary(pno):
+  screenshot_worker.drain()
+  d = screenshot_worker.durations
+  if d:
+    log_message(f"screenshot_save_mean={1000*sum(d)/len(d):.1f};screenshot_save_max={1000*max(d):.1f}", pno)
+
+# Columnar export of a session log for fast loading in R and Python
+# (see session_tables and write_tables in logformat.py).  Exporting a
+# session again replaces its files.
+def export_session(log_filename, dataset_dir="data/dataset"):
+  session = session_name(log_filename)
+  write_tables(session_tables(session, read_log(log_filename)), dataset_dir, session)
+
+# Continues an aborted session.  Needs to be called before the stimuli
+# are selected and shuffled, because it restores the session ID, the
+# seed of the random number generator, and the Latin square list of the
+# original session.  run_experiment then skips all pages that were
+# completed in the original session.
+def resume_session(sid):
+  global session_id, session_info, resumed_session, latin_square_list_label
+  with open(f"data/{sid}_state.json", "r") as f:
+    session_info = json.load(f)
+  session_id = sid
+  random.seed(session_info["session_seed"])
+  latin_square_list_label = session_info.get("latin_square_list")
+  resumed_session = True
+  print(f"Resuming session {session_id}")
+
+# Responds to the pages instead of a human participant, e.g. for
+# testing a new experiment or stimulus file or for measuring the
+# overhead of Chamois.  Pass it to run_experiment which will then hand
+# it to the pages in place of the window.  Blocking reads return the
+# response chosen by respond after a simulated delay; everything else
+# is passed on to the real window.  Times are in milliseconds and drawn
+# from log-normal distributions with the given mean and standard
+# deviation.  All delays and timers are multiplied by time_scale, so
+# with time_scale=0 a session runs as fast as the GUI allows.  For
+# scripted behaviour, override respond.
+class SimulatedParticipant:
+  def __init__(self, subject_id="simulated", time_scale=1, page_time=(2000, 800), word_time=(250, 100), seed=None, visible=True):
+    self.subject_id = subject_id
+    self.time_scale = time_scale
+    self.page_time  = page_time
+    self.word_time  = word_time
+    self.visible    = visible
+    self.rng        = random.Random(seed)
+    self.window     = None
+    self.page       = None
+    self.overheads  = []
+  def draw_time(self, mean_sd):
+    mean, sd = mean_sd
+    sigma2 = math.log(1 + (sd/mean)**2)
+    return self.rng.lognormvariate(math.log(mean) - sigma2/2, math.sqrt(sigma2)) / 1000
+  # Returns (delay in seconds, event, values) for the given page, or
+  # None to wait for real events of the window:
+  def respond(self, page):
+    if getattr(page, "ends_by_gaze", False):
+      return None
+    if isinstance(page, SubjectIDPage):
+      return self.draw_time(self.page_time), "Return:36", {"-SUBJECTID-": self.subject_id}
+    if isinstance(page, YesNoQuestionTrial):
+      return self.draw_time(self.page_time), self.rng.choice(["f:41", "j:44"]), {}
+    if isinstance(page, SelfPacedReadingTrial):
+      return self.draw_time(self.word_time), "space:65", {}
+    if isinstance(page, ReadingTrial):
+      return sum(self.draw_time(self.word_time) for w in page.stimulus.split()), "space:65", {}
+    return self.draw_time(self.page_time), "space:65", {}
+  def begin(self, window, page):
+    self.window    = window
+    self.page      = page
+    self.starttime = time.perf_counter()
+    self.waited    = 0
+  # Everything that isn't simulated waiting counts as overhead:
+  def end(self, page):
+    overhead = time.perf_counter() - self.starttime - self.waited
+    self.overheads.append(overhead)
+    page.metrics["overhead"] = f"{1000*overhead:.1f}"
+  def read(self, timeout=None, **kwargs):
+    if timeout is not None:
+      return self.window.read(timeout=int(timeout*self.time_scale), **kwargs)
+    response = self.respond(self.page)
+    if response is None:
+      return self.window.read(**kwargs)
+    delay, event, values = response
+    # Keep the GUI alive while waiting:
+    t = time.perf_counter()
+    deadline = t + delay*self.time_scale
+    while True:
+      e, v = self.window.read(timeout=max(0, int(1000*(deadline - time.perf_counter()))))
+      if e == WIN_CLOSED or time.perf_counter() >= deadline:
+        break
+    self.waited += time.perf_counter() - t
+    if e == WIN_CLOSED:
+      return e, v
+    return event, values
+  def __getattr__(self, name):
+    return getattr(self.window, name)
+  def __getitem__(self, key):
+    return self.window[key]
+
+# Pages can be a list or any other iterable, e.g. a generator that
+# creates the next page depending on earlier responses.  The widgets of
+# a page are only created just before the page is shown and destroyed
+# afterwards.  For iterables without length, the progress bar is
+# hidden unless the number of pages is given via npages.  If a
+# SimulatedParticipant is given, it responds to the pages.
+def run_experiment(pages, npages=None, participant=None):
+  global window, exp_starttime, screenshot_worker, session_log
   # Create data subdirectory if necessary:
   if not os.path.exists("data"):
       os.makedirs("data")
+  if npages is None and isinstance(pages, (list, tuple)):
+    npages = sum(isinstance(p, Page) for p in pages)
+  filename = f"{session_id}_log.tsv"
+  # When resuming, find the first page that wasn't completed and
+  # continue the clock where the original session stopped:
+  completed = {}
+  resume_pno = 0
+  time_offset = 0
+  if resumed_session:
+    recover_log("data/" + filename)
+    for row in read_log("data/" + filename):
+      time_offset = max(time_offset, float(row[2]), float(row[3] or 0))
+      if row[1] not in ("Message", "Metrics") and row[3]:
+        completed[int(row[0])] = row
+    resume_pno = max(completed, default=-1) + 1
+  else:
+    # Store what's needed to resume this session:
+    with open(f"data/{session_id}_state.json", "w") as f:
+      json.dump(session_info, f)
+  session_log = SessionLog("data/" + filename, log_flush_every, log_fsync_every)
+  i = 0
+  screenshot_worker = BackgroundWorker("screenshots", screenshot_queue_size)
   try:
     # Set up window:
-    layout = [[p.column for p in pages if isinstance(p, Page)]]
-    wrapper_layout = [[ProgressBar(len(layout[0])-1, orientation='h', expand_x=True, size=(20, 20), key='-PBAR-')],
-                      [Column(layout, expand_x=True, expand_y=True)]]
+    wrapper_layout = [[ProgressBar(max((npages or 1)-1, 1), orientation='h', expand_x=True, size=(20, 20), key='-PBAR-', visible=npages is not None)],
+                      [Column([[]], key='-PAGES-', expand_x=True, expand_y=True)]]
     window = Window('Experiment', wrapper_layout, keep_on_top=False, resizable=True, font=f"{font} {fontsize}", return_keyboard_events=True).Finalize()
+    templates.clear()
     window.Maximize()
     window.TKroot["cursor"] = "none"
+    if participant and not participant.visible:
+      window.set_alpha(0)
     # Run experiment:
-    exp_starttime = time.time()
-    i = 0
+    exp_starttime = time.perf_counter() - time_offset
+    # Screen size is needed to relate gaze coordinates to AOIs:
+    clock_screen = f"wall_clock={datetime.now().isoformat()};screen={window.TKroot.winfo_screenwidth()}x{window.TKroot.winfo_screenheight()}"
+    if resumed_session:
+      log_message(f"Session resumed at page {resume_pno};{clock_screen}", resume_pno)
+    else:
+      log_message(";".join(f"{k}={v}" for k,v in session_info.items()) + ";" + clock_screen, 0)
+    rerun = {}
     for p in pages:
-      p.activate(window, i)
-      if isinstance(p, Page):
-        window['-PBAR-'].update(current_count=i+1)
-        i += 1
+      # Skip what was completed in the original session, but remember
+      # the most recent setup item of each type (e.g. a calibration),
+      # since the setup doesn't carry over to the resumed session:
+      if i < resume_pno:
+        if isinstance(p, Page):
+          logged = completed.get(i, [None]*len(log_columns))
+          if (logged[1], logged[4], logged[5]) != tuple(str(v) if v!=None else '' for v in (p.type, p.item, p.condition)):
+            raise RuntimeError(f"Page {i} differs from the original session.  Were the stimuli or the script changed?")
+          i += 1
+        elif not isinstance(p, Message):
+          rerun.pop(p.type, None)
+          rerun[p.type] = p
+        continue
+      for p in [*rerun.values(), p]:
+        if isinstance(p, Page):
+          with trace("attach", p):
+            p.attach(window)
+        with trace("activate", p):
+          if participant and isinstance(p, Page):
+            participant.begin(window, p)
+            p.activate(participant, i)
+            participant.end(p)
+          else:
+            p.activate(window, i)
+        with trace("log", p):
+          session_log.write(p.get_data())
+          if getattr(p, "metrics", None):
+            session_log.write(p.get_metrics())
+        if isinstance(p, Page):
+          with trace("detach", p):
+            p.detach(window)
+            window['-PBAR-'].update(current_count=i+1)
+          i += 1
+      rerun.clear()
     window.close()
   except Exception as e:
     if type(e) == ExperimentAbortException:
@@ -316,46 +1034,68 @@ def run_experiment(pages):
     else:
       print("An error occurred.")
 
-    # Save data (emergency):
-    filename = f"{session_id}_log.tsv"
-    with open("data/" + filename, "w") as f:
-      f.write('\t'.join(["pno", "type", "starttime", "endtime", "item", "condition", "stimulus", "response", "screenshot", "metadata1", "metadata2"]))
-      f.write('\n')
-      for p in pages:
-        if not p.completed:
-          break
-        t = tuple(str(v) if v!=None else '' for v in p.get_data())
-        if t[0]=="Next":
-          continue
-        f.write("\t".join(t))
-        f.write("\n")
+    # Complete session log (emergency):
+    screenshot_summary(i)
+    session_log.close()
     print("Session log stored in: data/" + filename)
     # Raise exception again to complete.
     if type(e) != ExperimentAbortException:
       raise e
     else:
       sys.exit(1)
+  finally:
+    for f in cleanup_handlers:
+      try:
+        with trace("cleanup"):
+          f()
+      except Exception as e:
+        sys.stderr.write(f"Warning: Cleanup failed: {e}\n")
+    if tracing:
+      export_trace(f"data/{session_id}_trace")
 
-  # Save data (normal):
-  filename = f"{session_id}_log.tsv"
-  with open("data/" + filename, "w") as f:
-    f.write('\t'.join(["pno", "type", "starttime", "endtime", "item", "condition", "stimulus", "response", "screenshot", "metadata1", "metadata2"]))
-    f.write('\n')
-    for t in [p.get_data() for p in pages]:
-      t = tuple(str(v) if v!=None else '' for v in t)
-      if t[0]=="Next":
-        continue
-      f.write("\t".join(t))
-      f.write("\n")
+  # Complete session log (normal):
+  screenshot_summary(i)
+  # Marks the session as complete (see the aggregator in analysis.py):
+  log_message("Session completed" + (";simulated_participant=True" if participant else ""), i)
+  session_log.close()
+  if export_dataset:
+    export_session("data/" + filename, export_dataset)
+
+  if participant and participant.overheads:
+    o = participant.overheads
+    print(f"Simulated {len(o)} pages, overhead per page: mean {1000*sum(o)/len(o):.1f} ms, max {1000*max(o):.1f} ms")
 
   # If a Latin square was used, update our on-disk memory of completed
-  # lists:
+  # lists (not for simulated participants):
   if latin_square_list_label:
-    with open('tested_latin_square_lists.txt', 'a') as file:
-      file.write(f'{latin_square_list_label}\n')
+    confirm_latin_square_list(completed=not participant)
 
   print(f"Experiment finished.\nSession log stored in: data/{filename}")
 
+# Writes the recorded phases to <prefix>.json (Chrome trace event
+# format, one track per thread, times in microseconds since Chamois was
+# loaded) and a summary with one row per page type and phase to
+# <prefix>_summary.tsv (durations in milliseconds).
+def export_trace(prefix):
+  threads = list(dict.fromkeys(e[2] for e in trace_events))
+  events = [{"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": t}}
+            for tid, t in enumerate(threads)]
+  durations = {}
+  for name, page, thread, start, end in trace_events:
+    ptype = page.type if page else ""
+    events.append({"name": name, "cat": ptype or "session", "ph": "X", "pid": 1,
+                   "tid": threads.index(thread),
+                   "ts": (start - trace_origin) / 1000, "dur": (end - start) / 1000,
+                   "args": {"pno": page.pno, "type": ptype} if page else {}})
+    durations.setdefault((ptype, name), []).append((end - start) / 1e6)
+  with open(prefix + ".json", "w") as f:
+    json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+  with open(prefix + "_summary.tsv", "w") as f:
+    f.write("type\tphase\tn\tmean\tmedian\tmax\ttotal\n")
+    for (ptype, name), d in durations.items():
+      f.write(f"{ptype}\t{name}\t{len(d)}\t{sum(d)/len(d):.3f}\t{statistics.median(d):.3f}\t{max(d):.3f}\t{sum(d):.3f}\n")
+  print(f"Trace stored in: {prefix}.json")
+
 def check_latin_square(target_sentences):
   # Checks that all items have the same number of sentence:
   if len(set(Counter([x[0] for x in target_sentences]).values())) > 1:
@@ -376,39 +1116,234 @@ def check_latin_square(target_sentences):
   return items, conditions
 
 def latin_square_lists(target_sentences):
-  items, conditions = check_latin_square(target_sentences)
-  target_sentences.sort(key=lambda s:s[1])
-  target_sentences.sort(key=lambda s:s[0])
-  d = {}
-  for s in target_sentences:
-    d.setdefault(s[0], []).append(s)
-  lists = [list() for _ in conditions]
-  offset = 0
-  for i in d.keys():
-    for j,l in enumerate(lists):
-      l.append(d[i][(j + offset) % len(conditions)])
-    offset += 1
-  return dict(zip(conditions, lists))
+  square = LatinSquare(target_sentences)
+  return {label: square.list(label) for label in square.labels}
+
+# Counterbalancing of items across lists.  Rows are (item, condition,
+# …) as returned by load_stimuli.  List number j contains, for the o-th
+# item (items sorted), the (j+o)-th condition (conditions sorted,
+# cyclically).  This is the classic Latin square; lists are labelled
+# with the conditions in the order of the stimuli.
+#
+# Options:
+# - factor_separator: conditions are cells of crossed factors, e.g.
+#   "subj-high" with "-".  The design is checked for missing cells.
+# - partial: items may lack some of the conditions (partial Latin
+#   square).  A list then doesn't contain an item whose condition for
+#   that list is missing.
+# - between: levels of a between-subjects factor.  Every list exists
+#   once per level with labels "<condition>/<level>", so that lists and
+#   levels are balanced together (see block).
+#
+# The design is checked once when the LatinSquare is created; all
+# problems are reported together.  Problems that make the design
+# unusable raise an error, others are printed as warnings (see
+# problems and warnings).  A single list is generated in linear time
+# (see list).  For a stimulus file, latin_square_for_file caches the
+# result across sessions.
+class LatinSquare:
+  def __init__(self, target_sentences, factor_separator=None, partial=False, between=None, check=True):
+    self.rows     = list(target_sentences)
+    self.between  = list(between) if between else None
+    self.problems = []
+    self.warnings = []
+    self.cache    = {}
+    # Row numbers by item and condition:
+    cells = {}
+    for k, row in enumerate(self.rows):
+      item_cells = cells.setdefault(row[0], {})
+      if row[1] in item_cells:
+        self.problems.append(f"Item {row[0]}: condition {row[1]} appears more than once (rows {item_cells[row[1]]+1} and {k+1}).")
+      item_cells.setdefault(row[1], k)
+    if not cells:
+      raise RuntimeError("No stimuli.")
+    # Conditions in the order of the stimuli (as listed for the last
+    # item if all items have the same conditions):
+    all_conditions = list(dict.fromkeys(row[1] for row in self.rows))
+    last = list(cells[list(cells)[-1]])
+    self.conditions = last if set(last) == set(all_conditions) else all_conditions
+    self.order      = sorted(self.conditions)
+    self.items      = sorted(cells)
+    self.cells      = [cells[item] for item in self.items]
+    if check:
+      self.check(factor_separator, partial)
+    if self.warnings:
+      sys.stderr.write("".join(f"Warning: {w}\n" for w in self.warnings))
+    if self.problems:
+      raise RuntimeError("Latin square design is invalid:\n" + "\n".join("  " + p for p in self.problems))
+  def check(self, factor_separator, partial):
+    n, m = len(self.items), len(self.conditions)
+    for item, item_cells in zip(self.items, self.cells):
+      missing = [c for c in self.conditions if c not in item_cells]
+      if missing:
+        (self.warnings if partial else self.problems).append(f"Item {item} lacks condition(s): {', '.join(missing)}.")
+    if n % m:
+      self.warnings.append(f"{n} items can't be distributed evenly over {m} conditions; conditions will differ by one item per list.")
+    if factor_separator:
+      levels = [c.split(factor_separator) for c in self.conditions]
+      if len(set(map(len, levels))) > 1:
+        self.problems.append(f"Conditions have different numbers of factors: {', '.join(self.conditions)}.")
+      else:
+        factors = [sorted(set(l)) for l in zip(*levels)]
+        missing = [factor_separator.join(c) for c in itertools.product(*factors) if list(c) not in levels]
+        if missing:
+          (self.warnings if partial else self.problems).append(f"Cells of the crossed design without stimuli: {', '.join(missing)}.")
+  # Labels of all lists:
+  @property
+  def labels(self):
+    if self.between:
+      return [f"{c}/{b}" for b in self.between for c in self.conditions]
+    return list(self.conditions)
+  # Level of the between-subjects factor of a list:
+  def block(self, label):
+    return label.rsplit("/", 1)[1] if self.between else None
+  def list(self, label):
+    if label not in self.cache:
+      if label not in self.labels:
+        raise RuntimeError(f"Unknown Latin square list: {label}")
+      condition = label.rsplit("/", 1)[0] if self.between else label
+      self.cache[label] = self.indices(condition)
+    return [self.rows[k] for k in self.cache[label]]
+  # Row numbers of the list of the given condition:
+  def indices(self, condition):
+    j = self.conditions.index(condition)
+    m = len(self.order)
+    indices = []
+    for o, item_cells in enumerate(self.cells):
+      k = item_cells.get(self.order[(j + o) % m])
+      if k is not None:
+        indices.append(k)
+    return indices
+
+# LatinSquare for a stimulus file.  Checking the design and the row
+# numbers of the lists are cached in <filename>.latin_square.json, so
+# that later sessions with the same file (same content and options)
+# only need to load the stimuli.
+def latin_square_for_file(filename, **options):
+  with open(filename, "rb") as f:
+    key = hashlib.sha1(f.read() + repr(sorted(options.items())).encode()).hexdigest()
+  stimuli = load_stimuli(filename)
+  cache_file = filename + ".latin_square.json"
+  if os.path.isfile(cache_file):
+    with open(cache_file, "r") as f:
+      cached = json.load(f)
+    if cached["key"] == key:
+      square = LatinSquare(stimuli, options.get("factor_separator"), options.get("partial", False), options.get("between"), check=False)
+      square.cache = cached["lists"]
+      return square
+  square = LatinSquare(stimuli, **options)
+  for label in square.labels:
+    square.list(label)
+  with open(cache_file, "w") as f:
+    json.dump({"key": key, "lists": square.cache}, f)
+  return square
+
+# Several lab computers can run sessions of the same experiment from a
+# shared folder.  To keep the Latin square lists balanced, a list is
+# reserved when a session starts and confirmed when it is completed.
+# Counts of completed sessions and the current reservations are kept in
+# latin_square_state_file which is only accessed while holding a lock
+# (see FileLock).  A reservation of a session that crashed expires after
+# latin_square_reservation_ttl seconds.  latin_square_file (one line per
+# completed session) is still written for reference.  If the state file
+# doesn't exist, the counts are initialized from latin_square_file.
+
+# Lock for files that are shared by several computers.  The lock file
+# is created atomically (O_EXCL) which also works on network drives.  A
+# lock file older than stale seconds was left behind by a crash and is
+# removed.
+class FileLock:
+  def __init__(self, filename, timeout=30, stale=60):
+    self.filename = filename
+    self.timeout  = timeout
+    self.stale    = stale
+  def __enter__(self):
+    deadline = time.monotonic() + self.timeout
+    while True:
+      try:
+        fd = os.open(self.filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        os.write(fd, f"{socket.gethostname()} {os.getpid()}\n".encode())
+        os.close(fd)
+        return self
+      except FileExistsError:
+        try:
+          if time.time() - os.path.getmtime(self.filename) > self.stale:
+            os.remove(self.filename)
+            continue
+        except FileNotFoundError:
+          continue
+        if time.monotonic() > deadline:
+          raise RuntimeError(f"Could not acquire lock: {self.filename}")
+        time.sleep(0.05)
+  def __exit__(self, *exc):
+    os.remove(self.filename)
 
+def load_latin_square_state():
+  if os.path.isfile(latin_square_state_file):
+    with open(latin_square_state_file, "r") as f:
+      return json.load(f)
+  completed = Counter()
+  if os.path.isfile(latin_square_file):
+    with open(latin_square_file, 'r') as file:
+      completed = Counter(line.strip() for line in file if line.strip())
+  return {"completed": dict(completed), "reservations": {}}
+
+def save_latin_square_state(state):
+  tmp = f"{latin_square_state_file}.{socket.gethostname()}.{os.getpid()}"
+  with open(tmp, "w") as f:
+    json.dump(state, f, indent=1)
+  os.replace(tmp, latin_square_state_file)
+
+# Reserves the list with the fewest completed and reserved sessions
+# (the first of the given conditions in case of a tie).  A resumed
+# session renews the reservation of its list.
+def reserve_latin_square_list(conditions, label=None):
+  with FileLock(latin_square_state_file + ".lock"):
+    state = load_latin_square_state()
+    now = time.time()
+    reservations = {sid: r for sid, r in state["reservations"].items()
+                    if now - r["time"] < latin_square_reservation_ttl and sid != session_id}
+    if not label:
+      reserved = Counter(r["list"] for r in reservations.values())
+      label = min(conditions, key=lambda c: state["completed"].get(c, 0) + reserved[c])
+    reservations[session_id] = {"list": label, "time": now, "host": socket.gethostname()}
+    state["reservations"] = reservations
+    save_latin_square_state(state)
+  return label
+
+# Ends the reservation of the session.  If the session was completed,
+# its list is counted.
+def confirm_latin_square_list(completed=True):
+  with FileLock(latin_square_state_file + ".lock"):
+    state = load_latin_square_state()
+    state["reservations"].pop(session_id, None)
+    if completed:
+      state["completed"][latin_square_list_label] = state["completed"].get(latin_square_list_label, 0) + 1
+    save_latin_square_state(state)
+  if completed:
+    with open(latin_square_file, 'a') as file:
+      file.write(f'{latin_square_list_label}\n')
+
+# Takes stimuli or a LatinSquare:
 def next_latin_square_list_label(target_sentences):
   global latin_square_list_label
-  filename = "tested_latin_square_lists.txt"
-  items, conditions = check_latin_square(target_sentences)
-  if not os.path.isfile(filename):
-    latin_square_list_label = conditions[0]
+  square = target_sentences if isinstance(target_sentences, LatinSquare) else LatinSquare(target_sentences)
+  conditions = square.labels
+  # A resumed session uses the list of the original session:
+  if resumed_session and latin_square_list_label:
+    if latin_square_list_label not in conditions:
+      raise RuntimeError(f"Latin square list {latin_square_list_label} of the resumed session doesn't exist.")
+    reserve_latin_square_list(conditions, latin_square_list_label)
   else:
-    with open(filename, 'r') as file:
-      previous_lists = [line.strip() for line in file if line.strip()]
-    c = Counter(previous_lists)
-    x = [(cond, c[cond]) for cond in conditions]
-    x.sort(key=lambda s:s[1])
-    latin_square_list_label = x[0][0]
+    latin_square_list_label = reserve_latin_square_list(conditions)
+  session_info["latin_square_list"] = latin_square_list_label
   return latin_square_list_label
 
 def next_latin_square_list(target_sentences):
-  next_list_label = next_latin_square_list_label(target_sentences)
+  square = target_sentences if isinstance(target_sentences, LatinSquare) else LatinSquare(target_sentences)
+  next_list_label = next_latin_square_list_label(square)
   print(f'Next Latin square list: {next_list_label}')
-  return latin_square_lists(target_sentences)[next_list_label]
+  return square.list(next_list_label)
 
 def load_stimuli(filename):
   stimuli = []
@@ -423,3 +1358,144 @@ def load_stimuli(filename):
       stimuli.append(row)
   return stimuli
 
+# Orders stimuli randomly subject to constraints:
+#
+# - max_repeat: at most this many targets of the same condition in a row
+#   (fillers in between are ignored),
+# - min_fillers: at least this many fillers between two targets,
+# - min_distance: related stimuli (same value of related(row), by
+#   default the item number) are at least this many positions apart.
+#
+# Fillers are recognized by is_filler (default: condition "filler").
+# The order is built position by position, trying the remaining stimuli
+# in random order and backtracking when a position can't be filled.
+# Branches that can't have enough fillers left are cut early.  Each
+# attempt is limited to max_steps checks of a stimulus (default: 100 per
+# stimulus), after which a new attempt starts, so the time needed is
+# bounded by restarts × max_steps checks.  If no order is found, an
+# error is raised.  The seed is drawn from the session's random number
+# generator unless given, and recorded in session_info (and thus in the
+# log) as order_seed.
+def constrained_order(stimuli, max_repeat=None, min_fillers=0, min_distance=0, related=None, is_filler=None, seed=None, max_steps=None, restarts=10):
+  if seed is None:
+    seed = random.randrange(2**32)
+  session_info["order_seed"] = seed
+  rng = random.Random(seed)
+  is_filler = is_filler or (lambda row: row[1] == "filler")
+  related = related or (lambda row: row[0])
+  n = len(stimuli)
+  filler = [bool(is_filler(row)) for row in stimuli]
+  condition = [row[1] for row in stimuli]
+  key = [related(row) for row in stimuli]
+  max_steps = max_steps or 100*n
+  for attempt in range(restarts):
+    order = search_order(n, filler, condition, key, max_repeat, min_fillers, min_distance, rng, max_steps)
+    if order is not None:
+      return [stimuli[i] for i in order]
+  raise RuntimeError(f"No order of the stimuli satisfies the constraints (gave up after {restarts} × {max_steps} steps).  Try weaker constraints or more fillers.")
+
+# Depth-first search for constrained_order.  Returns a list of indices
+# or None if the step budget ran out.  All stimuli are kept in one list,
+# pool: pool[:p] is the order so far (p is the current depth), and the
+# rest are the stimuli that are left.  At each depth, the candidates are
+# drawn at random from pool[cursor:], where cursor marks the next untried
+# position of that depth, and moved to the cursor.  The swaps of a depth
+# are undone when the search backtracks, so that each step takes
+# constant time and the work is bounded by max_steps.
+def search_order(n, filler, condition, key, max_repeat, min_fillers, min_distance, rng, max_steps):
+  fillers_left = sum(filler)
+  targets_left = n - fillers_left
+  pool      = list(range(n))
+  cursor    = [0]    # next untried position in pool, for each depth
+  swaps     = [[]]   # draws at each depth, to undo them when backtracking
+  targets   = []     # conditions of the targets placed so far
+  since     = []     # fillers since the last target, for each position
+  last_seen = {}     # key -> positions at which it was placed
+  steps = 0
+  p = 0
+  while p < n:
+    k = cursor[-1]
+    if k == n:
+      # Dead end, restore the pool and undo the last placement:
+      for a, b in reversed(swaps.pop()):
+        pool[a], pool[b] = pool[b], pool[a]
+      cursor.pop()
+      if not cursor:
+        return None
+      p -= 1
+      k = cursor[-1] - 1
+      pool[p], pool[k] = pool[k], pool[p]
+      i = pool[k]
+      since.pop()
+      last_seen[key[i]].pop()
+      if filler[i]:
+        fillers_left += 1
+      else:
+        targets_left += 1
+        targets.pop()
+      continue
+    r = rng.randrange(k, n)
+    pool[k], pool[r] = pool[r], pool[k]
+    swaps[-1].append((k, r))
+    cursor[-1] = k + 1
+    i = pool[k]
+    steps += 1
+    if steps > max_steps:
+      return None
+    s = since[-1] if since else min_fillers
+    positions = last_seen.get(key[i])
+    if positions and p - positions[-1] < min_distance:
+      continue
+    if filler[i]:
+      s += 1
+      t, f = targets_left, fillers_left - 1
+    else:
+      if targets and s < min_fillers:
+        continue
+      if max_repeat and len(targets) >= max_repeat and all(c == condition[i] for c in targets[-max_repeat:]):
+        continue
+      s = 0
+      t, f = targets_left - 1, fillers_left
+    # Enough fillers left for the remaining targets?
+    if t and f < max(0, min_fillers - s) + min_fillers*(t - 1):
+      continue
+    # Place the candidate (undone via the cursor when backtracking):
+    pool[p], pool[k] = pool[k], pool[p]
+    since.append(s)
+    last_seen.setdefault(key[i], []).append(p)
+    if filler[i]:
+      fillers_left -= 1
+    else:
+      targets_left -= 1
+      targets.append(condition[i])
+    p += 1
+    cursor.append(p)
+    swaps.append([])
+  return pool
+
+# Decides for n trials whether a question follows, such that exactly
+# round(n × proportion) trials get one.  The seed is recorded in
+# session_info as question_seed.
+def question_flags(n, proportion, seed=None):
+  if seed is None:
+    seed = random.randrange(2**32)
+  session_info["question_seed"] = seed
+  k = round(n * proportion)
+  flags = [True]*k + [False]*(n - k)
+  random.Random(seed).shuffle(flags)
+  return flags
+
+# Checks before the session starts that all sentences fit on the screen
+# and precomputes the layouts of their words (see word_layout).  Takes
+# stimuli as returned by load_stimuli or next_latin_square_list.
+def check_layout(stimuli, screen_width=None):
+  if not screen_width:
+    screen_width = measuring_root().winfo_screenwidth()
+  x0 = text_start()
+  too_wide = []
+  for s in stimuli:
+    end = x0 + word_layout(s[2])[-1][2]
+    if end > screen_width:
+      too_wide.append(f"  Item {s[0]}, condition {s[1]}: {end-screen_width} pixels too wide: {s[2]}")
+  if too_wide:
+    raise RuntimeError(f"{len(too_wide)} sentence(s) extend beyond the screen ({screen_width} pixels):\n" + "\n".join(too_wide))
@@ -14,6 +14,10 @@ font = "Courier"
 fontsize = 22
 wordspacing = 18
 
+# Resume an aborted session, e.g.: ./demo_experiment_tpx.py 20240912_082813
+if len(sys.argv) > 1:
+  resume_session(sys.argv[1])
+
 # Stimuli:
 
 practice_sentence = [
@@ -39,7 +43,13 @@ fillers = [
 
 stimuli = next_latin_square_list(target_sentences)
 stimuli += fillers
-random.shuffle(stimuli)
+# No more than two targets of the same condition in a row:
+stimuli = constrained_order(stimuli, max_repeat=2)
+# Comprehension questions after exactly half of the sentences:
+questions = question_flags(len(stimuli), 0.5)
+
+# Check that all sentences fit on the screen:
+check_layout(practice_sentence + stimuli)
 
 # Structure of the experiment:
 
@@ -74,11 +84,13 @@ for i,c,s,q in practice_sentence:
 pages.append(
   CenteredInstructions("Now, on to the real experiment!"))
 
-for i,c,s,q in stimuli:
+for (i,c,s,q), question in zip(stimuli, questions):
+  pages.append(TPxNext(tpx))
+  # Quick check of the calibration before each sentence:
+  pages.append(TPxDriftCheck(tpx))
   pages.append(TPxReadingTrial(i,c,s,tpx,trigger_radius=200))
-  if random.choice([True, False]):
+  if question:
     pages.append(YesNoQuestionTrial(i,c,q))
-  pages.append(TPxNext(tpx))
 
 # Thank you screen:
 pages.append(
@@ -0,0 +1,191 @@
+# Format of the data files written by Chamois and TPx.py (session log,
+# its index, gaze data) and of the tables written by export_session.
+# chamois.py loads this file and analysis.py imports it, so that both
+# read the same format.  Apart from reading gaze data, it only needs the
+# standard library.
+
+import os, re
+
+# PyArrow is optional.  Without it, the columnar export of session logs
+# (see write_tables) uses NumPy files instead of Parquet.
+try:
+  import pyarrow, pyarrow.parquet
+except ImportError:
+  pyarrow = None
+
+# Columns of the session log:
+log_columns = ["pno", "type", "starttime", "endtime", "item", "condition", "stimulus", "response", "screenshot", "metadata1", "metadata2"]
+
+# Columns of the gaze samples of TRACKPixx3 trackers:
+gaze_columns = ['TimeTag', 'LeftEyeX', 'LeftEyeY',
+                'LeftPupilDiameter', 'RightEyeX', 'RightEyeY',
+                'RightPupilDiameter', 'DigitalIn', 'LeftBlink', 'RightBlink',
+                'DigitalOut', 'LeftEyeFixationFlag', 'RightEyeFixationFlag',
+                'LeftEyeSaccadeFlag', 'RightEyeSaccadeFlag', 'MessageCode',
+                'LeftEyeRawX', 'LeftEyeRawY', 'RightEyeRawX', 'RightEyeRawY']
+
+# metadata1 of a ReadingTrial: the box of each word (x1,y1,x2,y2),
+# separated by semicolons.
+aoi_pattern = r'(\d+,\d+,\d+,\d+;)*\d+,\d+,\d+,\d+'
+
+# Columns and types of the exported tables whose columns don't depend
+# on the experiment (the pages table has a session column followed by
+# log_columns).  Types are named as in PyArrow.
+table_schemas = {
+  "aois": {"session": "string", "pno": "int64", "word_index": "int64", "word": "string",
+           "x1": "int64", "y1": "int64", "x2": "int64", "y2": "int64"},
+  "metrics": {"session": "string", "pno": "int64", "name": "string", "value": "float64"},
+}
+
+def log_index_filename(filename):
+  return re.sub(r'\.tsv$', '', filename) + ".idx"
+
+def session_name(log_filename):
+  return re.sub(r'_log\.tsv$', '', os.path.basename(log_filename))
+
+# Loads the samples of one trial as a NumPy array with the columns in
+# gaze_columns, without reading the rest of the file.  ref is metadata2
+# of the trial: either a block of the binary gaze file of the session
+# ("file:first row:number of rows") or, for sessions recorded with older
+# versions of Chamois, the name of a CSV file.  NumPy (and pandas for
+# CSV files) are only needed when gaze data is read.
+def read_gaze(ref, data_dir="data"):
+  import numpy
+  if ref.endswith(".csv"):
+    import pandas
+    return pandas.read_csv(os.path.join(data_dir, os.path.basename(ref)))[gaze_columns].to_numpy(dtype=float)
+  filename, offset, nrows = ref.rsplit(":", 2)
+  ncols = len(gaze_columns)
+  data = numpy.fromfile(os.path.join(data_dir, filename), dtype='<f8',
+                        count=int(nrows)*ncols, offset=int(offset)*ncols*8)
+  return data.reshape(-1, ncols)
+
+def is_gaze_ref(ref):
+  return bool(re.match(r'.+:\d+:\d+$', ref)) or ref.endswith(".csv")
+
+# The entries (offset, length, checksum) of the index of a session log.
+# The index is written before the row, so a crash may leave a partial
+# line at the end.  Reading stops at the first line that is incomplete
+# or doesn't parse.  Returns the entries and the number of lines that
+# were left out.
+def read_index(filename):
+  with open(filename, "r") as f:
+    lines = f.readlines()
+  entries = []
+  for line in lines:
+    try:
+      entry = tuple(int(x) for x in line.split("\t"))
+    except ValueError:
+      break
+    if len(entry) != 3 or not line.endswith("\n"):
+      break
+    entries.append(entry)
+  return entries, len(lines) - len(entries)
+
+# Returns the rows of a session log as lists of strings (without the
+# header).  The index is used if available since stimuli may contain
+# line breaks.  Entries that point beyond the end of the log (rows that
+# weren't written before a crash) are left out.
+def read_log(filename):
+  with open(filename, "rb") as f:
+    data = f.read()
+  index = log_index_filename(filename)
+  if os.path.exists(index):
+    entries, _ = read_index(index)
+    lines = [data[offset:offset+length] for offset, length, _ in entries
+             if offset + length <= len(data)]
+  else:
+    lines = data.splitlines(keepends=True)[1:]
+  return [line.decode().rstrip("\n").split("\t") for line in lines]
+
+# The (name, value) pairs in metadata1 of a Metrics row.  Values are
+# strings: numbers or "NA".
+def parse_metrics(metadata1):
+  return [tuple(m.split("=", 1)) for m in metadata1.split(";") if m]
+
+# Values of Metrics rows are numbers.  Anything else (e.g. "NA") is
+# missing.
+def metric_value(value):
+  try:
+    return float(value)
+  except ValueError:
+    return None
+
+# The tables of the columnar export of a session log, as columns (lists)
+# by table:
+#
+# - pages: one row per page and message, columns as in the log with
+#   proper types (without the Metrics rows),
+# - aois: one row per word of each ReadingTrial (pno, word_index, word,
+#   x1, y1, x2, y2),
+# - metrics: one row per measurement of the Metrics rows (pno, name,
+#   value).
+#
+# All tables start with a session column.
+def session_tables(session, rows):
+  pages = [r for r in rows if r[1] != "Metrics"]
+  def number(v, kind=float):
+    return kind(v) if v != '' else None
+  # Items are numbers unless an experiment uses other labels:
+  items = [r[4] for r in pages]
+  item_kind = int if all(i.isdigit() for i in items if i) else str
+  tables = {"pages": {"session": [session]*len(pages)}, "aois": {}, "metrics": {}}
+  for i, c in enumerate(log_columns):
+    if c in ("pno", "starttime", "endtime"):
+      tables["pages"][c] = [number(r[i], int if c == "pno" else float) for r in pages]
+    elif c == "item":
+      tables["pages"][c] = [number(v, item_kind) if item_kind == int else v for v in items]
+    else:
+      tables["pages"][c] = [r[i] for r in pages]
+  aois = tables["aois"] = {k: [] for k in table_schemas["aois"]}
+  metrics = tables["metrics"] = {k: [] for k in table_schemas["metrics"]}
+  for r in rows:
+    if r[1] == "Metrics":
+      for name, value in parse_metrics(r[9]):
+        metrics["session"].append(session)
+        metrics["pno"].append(int(r[0]))
+        metrics["name"].append(name)
+        metrics["value"].append(metric_value(value))
+    elif re.fullmatch(aoi_pattern, r[9]) and "ReadingTrial" in r[1]:
+      for j, (word, box) in enumerate(zip(r[6].split(), r[9].split(";"))):
+        x1, y1, x2, y2 = (int(v) for v in box.split(","))
+        for k, v in zip(aois, (session, int(r[0]), j, word, x1, y1, x2, y2)):
+          aois[k].append(v)
+  return tables
+
+# Writes the tables of a session (see session_tables), each as one file
+# in a subdirectory of dataset_dir, so that sessions can be added one by
+# one and a whole directory can be loaded at once (e.g.
+# pandas.read_parquet or arrow::open_dataset in R).  Existing files of
+# the session are replaced.  The format is Parquet if PyArrow is
+# installed and NumPy's .npz otherwise.
+def write_tables(tables, dataset_dir, session):
+  for name, columns in tables.items():
+    os.makedirs(os.path.join(dataset_dir, name), exist_ok=True)
+    filename = os.path.join(dataset_dir, name, session)
+    # Write to a temporary file first, so that readers never see a
+    # partially written file:
+    if pyarrow:
+      pyarrow.parquet.write_table(pyarrow.table(columns, schema=export_schemas().get(name)), filename + ".tmp")
+      os.replace(filename + ".tmp", filename + ".parquet")
+    else:
+      import numpy
+      # Missing numbers become NaN, and empty columns get the type in
+      # table_schemas:
+      def array(values, kind):
+        if any(isinstance(v, str) for v in values) or kind == "string":
+          return numpy.array(values, dtype=str)
+        if None in values:
+          return numpy.array([numpy.nan if v is None else v for v in values], dtype=float)
+        return numpy.array(values, dtype=kind)
+      kinds = table_schemas.get(name, {})
+      with open(filename + ".tmp", "wb") as f:
+        numpy.savez(f, **{k: array(vs, kinds.get(k)) for k, vs in columns.items()})
+      os.replace(filename + ".tmp", filename + ".npz")
+
+# Column types of the tables whose columns don't depend on the
+# experiment (see table_schemas), so that sessions without AOIs or
+# metrics have the same schema as the others:
+def export_schemas():
+  return {name: pyarrow.schema([(c, getattr(pyarrow, t)()) for c, t in columns.items()])
+          for name, columns in table_schemas.items()}